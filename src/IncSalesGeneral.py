@@ -1,21 +1,41 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from google.cloud import bigquery, storage
 from google.oauth2 import service_account
+import hashlib
+import heapq
 from io import BytesIO, StringIO
 import json
 import math
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 from pynndescent import NNDescent
 import os
 import pandas as pd
+import pickle
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pynndescent
 import pytz
+import re
+import resource
+import scipy.sparse as sp
+import sem_runtime
+from sklearn.neighbors import NearestNeighbors
 import sys
 import time
 
 
 tz = pytz.timezone('Australia/Sydney')
 
+# Sorted feature arrays and offsets of the segments being matched. Forked
+# workers inherit this context instead of receiving pickled copies.
+_SEGMENT_CONTEXT = {}
+
+# Frames and unweighted features shared by the weight sweep jobs.
+_SWEEP_CONTEXT = {}
+
 
 def load_config(config):
     """Returns a dictionary from the configuration."""
@@ -41,27 +61,28 @@ def exclude_lapsed(df):
     return df
 
 
+CVM_LEVELS = ['HVHIGH',
+              'HVMED',
+              'MVHIGH',
+              'MVMEDA',
+              'MVMEDB',
+              'LVHFA',
+              'LVHFB',
+              'LVLF',
+              'LVLFB',
+              'LOW',
+              'LAPSED',
+              'INACTIVE']
+
+CVM_VALUES = [4, 4, 3, 3, 3, 2, 2, 1, 1, 2.5, 0, 0]
+CVM_SOWS = [4, 2.5, 4, 3, 2, 4, 2.5, 4, 2.5, 1, 2.5, 1]  # according to the Quantium CVM model
+
+
 def cvm_encoding(df):
     """Performs the encoding."""
 
-    cvm = ['HVHIGH',
-           'HVMED',
-           'MVHIGH',
-           'MVMEDA',
-           'MVMEDB',
-           'LVHFA',
-           'LVHFB',
-           'LVLF',
-           'LVLFB',
-           'LOW',
-           'LAPSED',
-           'INACTIVE']
-
-    cvm_v = [4, 4, 3, 3, 3, 2, 2, 1, 1, 2.5, 0, 0]
-    cvm_sow = [4, 2.5, 4, 3, 2, 4, 2.5, 4, 2.5, 1, 2.5, 1]  # according to the Quantium CVM model
-
-    cvm_v_dict = dict(zip(cvm, cvm_v))
-    cvm_sow_dict = dict(zip(cvm, cvm_sow))
+    cvm_v_dict = dict(zip(CVM_LEVELS, CVM_VALUES))
+    cvm_sow_dict = dict(zip(CVM_LEVELS, CVM_SOWS))
 
     df['CVM_value'] = df['cvm'].map(cvm_v_dict)
     df['CVM_SOW'] = df['cvm'].map(cvm_sow_dict)
@@ -72,6 +93,39 @@ def cvm_encoding(df):
     return df
 
 
+def prepare_cvm(df, exclude=None, encode_cvm=False):
+    """Filters and encodes the CVM in one pass over its category codes.
+
+    Rows whose CVM is in 'exclude' are removed, as exclude_inactive and
+    exclude_lapsed do, and with 'encode_cvm' the CVM is replaced by its
+    value and share of wallet, as cvm_encoding does. Both are lookups of
+    per-category tables by the codes, so the frame is copied at most once.
+    """
+
+    cvm = df['cvm'] if hasattr(df['cvm'], 'cat') else df['cvm'].astype('category')
+    levels = pd.Series(cvm.cat.categories)
+    codes = cvm.cat.codes.to_numpy()
+
+    # Missing values have code -1, which reads the last entry of each table.
+    drop = np.append(levels.isin(exclude or []).to_numpy(), False)
+    mask = ~drop[codes]
+
+    out = df if mask.all() else df[mask]
+
+    if encode_cvm:
+        value = np.append(levels.map(dict(zip(CVM_LEVELS, CVM_VALUES))).to_numpy(dtype=np.float32), np.nan)
+        sow = np.append(levels.map(dict(zip(CVM_LEVELS, CVM_SOWS))).to_numpy(dtype=np.float32), np.nan)
+        out = out.drop(columns='cvm')
+        out['CVM_value'] = value[codes[mask]]
+        out['CVM_SOW'] = sow[codes[mask]]
+        print("{datetime}\tCVM encoding produced {numerr} error(s).".format(datetime=datetime.now(tz), numerr=int(np.isnan(out['CVM_SOW'].values).sum())))
+
+    if out is not df:
+        out.index = pd.RangeIndex(out.shape[0])
+
+    return out
+
+
 def cvm_encoding_proc(target, control, encode_cvm=True, cat_vars=None, num_vars=None):
     """Encodes the CVM categorical variable to numerical variables."""
 
@@ -94,22 +148,1110 @@ def cvm_encoding_proc(target, control, encode_cvm=True, cat_vars=None, num_vars=
     return target, control, cat_vars, num_vars
 
 
+def segment_partition(target, control, cat_vars):
+    """Sorts Target and Control once by the codes of the categorical variables.
+
+    Every combination of the categorical variables found in Target is a
+    segment. After sorting, each segment is a contiguous block of rows in
+    both Target and Control, located by the start and end offsets returned.
+    Rows without a segment (missing categories in Target, or combinations not
+    found in Target for Control) are sorted to the front.
+
+    Returns:
+        dictionary: sort orders 't_order' and 'c_order', segment values 'keys'
+        and the offsets 't_start', 't_end', 'c_start' and 'c_end'
+    """
+
+    t_codes = np.zeros(target.shape[0], dtype=np.int64)
+    c_codes = np.zeros(control.shape[0], dtype=np.int64)
+
+    for var in cat_vars:
+        levels = np.unique(target[var].dropna().values)
+        t_var = pd.Categorical(target[var], categories=levels).codes.astype(np.int64)
+        c_var = pd.Categorical(control[var], categories=levels).codes.astype(np.int64)
+
+        t_codes = np.where((t_codes < 0) | (t_var < 0), -1, t_codes * len(levels) + t_var)
+        c_codes = np.where((c_codes < 0) | (c_var < 0), -1, c_codes * len(levels) + c_var)
+
+        # Keep the combined codes compact so they never overflow.
+        seg_codes = np.unique(t_codes[t_codes >= 0])
+        t_codes = np.where(t_codes >= 0, np.searchsorted(seg_codes, t_codes), -1)
+        c_codes = np.where(np.isin(c_codes, seg_codes), np.searchsorted(seg_codes, c_codes), -1)
+
+    t_order = np.argsort(t_codes, kind='stable')
+    c_order = np.argsort(c_codes, kind='stable')
+    t_sorted = t_codes[t_order]
+    c_sorted = c_codes[c_order]
+
+    seg_codes = np.unique(t_sorted[t_sorted >= 0])
+    t_start = np.searchsorted(t_sorted, seg_codes, side='left')
+
+    return {'t_order': t_order,
+            'c_order': c_order,
+            'keys': target.iloc[t_order[t_start]][cat_vars].reset_index(drop=True),
+            't_start': t_start,
+            't_end': np.searchsorted(t_sorted, seg_codes, side='right'),
+            'c_start': np.searchsorted(c_sorted, seg_codes, side='left'),
+            'c_end': np.searchsorted(c_sorted, seg_codes, side='right')}
+
+
+def downsample_control(X_t, X_c, part, max_ratio=20, min_control=50000, n_bins=4, loss_sample=2000, seed=0):
+    """Caps the Control of oversized segments at a multiple of their Target.
+
+    A segment keeps at most 'max_ratio' Control rows per Target row, but
+    never fewer than 'min_control'. The rows kept are a stratified sample:
+    the Control of the segment is ordered by the quantile bins of every
+    numerical variable (random within a bin) and every n-th row is taken,
+    so each stratum keeps its share of the Control.
+
+    Sparse features are stratified by the sum and the number of the non-zero
+    features of each row instead.
+
+    The loss is estimated on up to 'loss_sample' Targets of the sampled
+    segments, from their exact nearest distance to the full and to the kept
+    Control.
+
+    Returns:
+        tuple: mask of the sorted Control rows kept, and a dataframe with the
+        sizes, sampling ratio and estimated distances per segment
+    """
+
+    rng = np.random.default_rng(seed)
+    keep = np.ones(X_c.shape[0], dtype=bool)
+
+    n_t = part['t_end'] - part['t_start']
+    n_c = part['c_end'] - part['c_start']
+    n_kept = np.minimum(n_c, np.maximum(n_t * max_ratio, min_control))
+
+    for i in np.flatnonzero(n_kept < n_c):
+        c_lo, c_hi = part['c_start'][i], part['c_end'][i]
+        data = X_c[c_lo:c_hi]
+        if sp.issparse(data):
+            data = np.column_stack([np.asarray(data.sum(axis=1)).ravel(), np.diff(data.indptr)])
+
+        strata = np.zeros(data.shape[0], dtype=np.int64)
+        for j in range(data.shape[1]):
+            edges = np.unique(np.quantile(data[:, j], np.linspace(0, 1, n_bins + 1)[1:-1]))
+            strata = strata * (len(edges) + 1) + np.searchsorted(edges, data[:, j], side='right')
+
+        order = np.lexsort((rng.random(data.shape[0]), strata))
+        picked = order[(np.arange(n_kept[i]) * (data.shape[0] / float(n_kept[i]))).astype(np.int64)]
+
+        keep[c_lo:c_hi] = False
+        keep[c_lo + picked] = True
+
+    report = part['keys'].copy()
+    report['n_target'] = n_t
+    report['n_control'] = n_c
+    report['n_control_kept'] = n_kept
+    report['sampling_ratio'] = n_kept / np.maximum(n_c, 1).astype(float)
+    report['dist_full'] = np.nan
+    report['dist_sampled'] = np.nan
+
+    sampled = np.flatnonzero(n_kept < n_c)
+    share = min(1.0, loss_sample / float(max(n_t[sampled].sum(), 1)))
+
+    for i in sampled:
+        t_lo, t_hi = part['t_start'][i], part['t_end'][i]
+        c_lo, c_hi = part['c_start'][i], part['c_end'][i]
+        rows = X_t[t_lo:t_hi][rng.random(t_hi - t_lo) < share]
+        if rows.shape[0] == 0:
+            continue
+        full = ExactIndex(X_c[c_lo:c_hi], algorithm='brute').query(rows, k=1)[1]
+        kept = ExactIndex(X_c[c_lo:c_hi][keep[c_lo:c_hi]], algorithm='brute').query(rows, k=1)[1]
+        report.loc[i, 'dist_full'] = float(full.mean())
+        report.loc[i, 'dist_sampled'] = float(kept.mean())
+
+    return keep, report
+
+
+class ExactIndex:
+    """Exact nearest neighbour search with the query interface of NNDescent.
+
+    Attributes:
+        algorithm (string): 'brute', 'kd_tree' or 'ball_tree'
+    """
+
+    def __init__(self, data, algorithm='kd_tree', n_jobs=-1):
+
+        self.algorithm = algorithm
+        self.nn = NearestNeighbors(algorithm=algorithm, n_jobs=sem_runtime.threads() if n_jobs == -1 else n_jobs).fit(data)
+
+    def query(self, query_data, k=1):
+        dist, ind = self.nn.kneighbors(query_data, n_neighbors=k)
+        return ind, dist.astype(np.float32)
+
+
+class TunedNNDescent(NNDescent):
+    """NNDescent index that is queried with the epsilon chosen for it.
+
+    Attributes:
+        query_epsilon (float): search epsilon used by query
+    """
+
+    def __init__(self, data, query_epsilon=0.1, **kwargs):
+
+        self.query_epsilon = query_epsilon
+        super(TunedNNDescent, self).__init__(data, **kwargs)
+
+    def query(self, query_data, k=10, epsilon=None):
+        return super(TunedNNDescent, self).query(query_data, k=k, epsilon=self.query_epsilon if epsilon is None else epsilon)
+
+
+class GridIndex:
+    """Coarsened exact matching on a hash grid, with the query interface of NNDescent.
+
+    Every variable is cut into 'bins' equal bins between its minimum and
+    maximum over the Control, and the Control rows are sorted by the hash of
+    their cell. A Target is compared exactly with up to 'max_candidates'
+    Control rows of its own cell, or of the cells next to it along each
+    variable when its cell is empty.
+
+    With 'refine', the Targets whose grid match is not certainly the nearest
+    (a closer Control could lie across the cell boundary, or the cell was
+    not compared in full) are queried again with that engine, so the grid
+    is a fast first pass. Targets without any candidate always are.
+
+    Attributes:
+        bins (int): number of bins per variable
+        max_candidates (int): Control rows compared per cell
+        refine (string): engine of the second pass, None for the grid only
+    """
+
+    def __init__(self, data, bins=10, max_candidates=64, refine=None, n_jobs=-1):
+
+        self.bins = bins
+        self.max_candidates = max_candidates
+        self.refine = refine
+        self.n_jobs = n_jobs
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+
+        self.lo = self.data.min(axis=0)
+        width = self.data.max(axis=0) - self.lo
+        self.width = np.where(width > 0, width / bins, 1).astype(np.float32)
+        self.mult = np.random.default_rng(0).integers(1, 2 ** 62, size=self.data.shape[1]).astype(np.uint64) | np.uint64(1)
+
+        codes = self._codes(self._cells(self.data))
+        self.order = np.argsort(codes, kind='stable')
+        self.keys, self.start = np.unique(codes[self.order], return_index=True)
+        self.end = np.append(self.start[1:], self.data.shape[0])
+        self._fallback = None
+
+    def _cells(self, X):
+        return np.clip(np.floor((X - self.lo) / self.width), 0, self.bins - 1).astype(np.int64)
+
+    def _codes(self, cells):
+        # Wraps around modulo 2**64; a rare collision only adds candidates.
+        return (cells.astype(np.uint64) * self.mult).sum(axis=1, dtype=np.uint64)
+
+    def _candidates(self, cells):
+        pos = np.minimum(np.searchsorted(self.keys, self._codes(cells)), len(self.keys) - 1)
+        found = self.keys[pos] == self._codes(cells)
+        size = np.where(found, self.end[pos] - self.start[pos], 0)
+        offsets = np.arange(self.max_candidates)
+        cand = np.where(offsets < size[:, None], self.start[pos][:, None] + offsets, -1)
+        return np.where(cand >= 0, self.order[np.maximum(cand, 0)], -1), size
+
+    def _nearest(self, X, cand, k):
+        # The k closest of each row's candidates, compared in blocks of rows.
+        idx = np.full((X.shape[0], k), -1, dtype=np.int64)
+        dst = np.full((X.shape[0], k), np.inf, dtype=np.float32)
+        chunk = max(1, 2 ** 22 // (cand.shape[1] * X.shape[1]))
+        for lo in range(0, X.shape[0], chunk):
+            c = cand[lo:lo + chunk]
+            d = ((X[lo:lo + chunk, None, :] - self.data[np.maximum(c, 0)]) ** 2).sum(axis=2)
+            d[c < 0] = np.inf
+            top = np.argsort(d, axis=1, kind='stable')[:, :k]
+            idx[lo:lo + chunk, :top.shape[1]] = np.take_along_axis(c, top, axis=1)
+            dst[lo:lo + chunk, :top.shape[1]] = np.sqrt(np.take_along_axis(d, top, axis=1))
+        return idx, dst
+
+    def query(self, query_data, k=1):
+        X = np.ascontiguousarray(query_data, dtype=np.float32)
+        cells = self._cells(X)
+        cand, size = self._candidates(cells)
+        idx, dst = self._nearest(X, cand, k)
+        del cand
+
+        # Only the Targets in empty cells are compared with the next cells,
+        # a block of them at a time.
+        empty = np.flatnonzero(size == 0)
+        chunk = max(1, 2 ** 22 // (2 * X.shape[1] * self.max_candidates))
+        for lo in range(0, empty.shape[0], chunk):
+            rows = empty[lo:lo + chunk]
+            near = []
+            for j in range(X.shape[1]):
+                for step in (-1, 1):
+                    moved = cells[rows].copy()
+                    moved[:, j] += step
+                    inside = (moved[:, j] >= 0) & (moved[:, j] < self.bins)
+                    c, _ = self._candidates(np.clip(moved, 0, self.bins - 1))
+                    near.append(np.where(inside[:, None], c, -1))
+            idx[rows], dst[rows] = self._nearest(X[rows], np.concatenate(near, axis=1), k)
+
+        redo = ~np.isfinite(dst[:, -1])
+        if self.refine is not None:
+            # The distance to the nearest cell boundary, open at the outer bins.
+            offset = X - (self.lo + cells * self.width)
+            margin = np.minimum(np.where(cells > 0, offset, np.inf), np.where(cells < self.bins - 1, self.width - offset, np.inf)).min(axis=1)
+            redo |= (size == 0) | (size > self.max_candidates) | (dst[:, -1] > margin)
+
+        if redo.any():
+            if self._fallback is None:
+                self._fallback = build_index(self.data, engine=self.refine or 'auto', n_jobs=self.n_jobs)
+            idx[redo], dst[redo] = self._fallback.query(X[redo], k=k)
+
+        idx[~np.isfinite(dst)] = -1
+        return idx, dst
+
+
+# NNDescent parameters by the number of Control rows of a segment, first
+# matching tier wins. Larger graphs get fewer neighbours, trees and
+# candidates, which cuts the build time, and a wider query epsilon, which
+# recovers the recall. These are starting values, not calibrated on SEM
+# data; sem_benchmark.py --tiers reports the recall and time of each tier
+# per Control size. A None value leaves the pynndescent default.
+NNDESCENT_TIERS = [{'max_control': 200000, 'n_neighbors': 50, 'n_trees': None, 'max_candidates': None, 'epsilon': 0.1},
+                   {'max_control': 2000000, 'n_neighbors': 30, 'n_trees': 24, 'max_candidates': 30, 'epsilon': 0.15},
+                   {'max_control': None, 'n_neighbors': 24, 'n_trees': 16, 'max_candidates': 24, 'epsilon': 0.2}]
+
+# Graphs over more dimensions than this get one more neighbour per extra
+# dimension.
+NNDESCENT_BASE_DIM = 10
+
+
+def nndescent_params(n_control, n_dim, tiers=None, n_neighbors_tree=None):
+    """Returns the NNDescent parameters of a Control of the given size.
+
+    The tier is the first of 'tiers' (NNDESCENT_TIERS by default) whose
+    'max_control' holds the Control. An explicit 'n_neighbors_tree' fixes
+    the number of neighbours of the graph.
+    """
+
+    tier = next(x for x in (tiers or NNDESCENT_TIERS) if x.get('max_control') is None or n_control <= x['max_control'])
+
+    n_neighbors = tier.get('n_neighbors', 30) + max(0, n_dim - NNDESCENT_BASE_DIM)
+    if n_neighbors_tree is not None:
+        n_neighbors = n_neighbors_tree
+
+    return {'n_neighbors': n_neighbors,
+            'n_trees': tier.get('n_trees'),
+            'max_candidates': tier.get('max_candidates'),
+            'epsilon': tier.get('epsilon', 0.1)}
+
+
+def _build_nndescent(data, n_neighbors_tree=None, n_jobs=-1, tiers=None, grid=None):
+    params = nndescent_params(data.shape[0], data.shape[1], tiers=tiers, n_neighbors_tree=n_neighbors_tree)
+    print("{datetime}\tNNDescent parameters: {params}".format(datetime=datetime.now(tz), params=params))
+    return TunedNNDescent(data, query_epsilon=params['epsilon'], n_neighbors=params['n_neighbors'], n_trees=params['n_trees'], max_candidates=params['max_candidates'], n_jobs=n_jobs)
+
+
+def _build_brute(data, n_neighbors_tree=None, n_jobs=-1, tiers=None, grid=None):
+    return ExactIndex(data, algorithm='brute', n_jobs=n_jobs)
+
+
+def _build_kd_tree(data, n_neighbors_tree=None, n_jobs=-1, tiers=None, grid=None):
+    return ExactIndex(data, algorithm='kd_tree', n_jobs=n_jobs)
+
+
+def _build_ball_tree(data, n_neighbors_tree=None, n_jobs=-1, tiers=None, grid=None):
+    return ExactIndex(data, algorithm='ball_tree', n_jobs=n_jobs)
+
+
+def _build_grid(data, n_neighbors_tree=None, n_jobs=-1, tiers=None, grid=None):
+    return GridIndex(data, n_jobs=n_jobs, **(grid or {}))
+
+
+# Index builders available to the matching. Each returns an object with a
+# query(query_data, k) method returning the indices and distances.
+MATCH_ENGINES = {'nndescent': _build_nndescent,
+                 'brute': _build_brute,
+                 'kd_tree': _build_kd_tree,
+                 'ball_tree': _build_ball_tree,
+                 'grid': _build_grid}
+
+# Engines that only index dense features.
+DENSE_ENGINES = ['kd_tree', 'ball_tree', 'grid']
+
+ENGINE_THRESHOLDS = {'brute_max_control': 2000,
+                     'exact_max_control': 200000,
+                     'kd_tree_max_dim': 15}
+
+
+def select_engine(n_control, n_dim, engine='auto', thresholds=None, sparse=False):
+    """Returns the name of the engine used to index a Control of the given size.
+
+    With 'auto', small Controls are searched by brute force, medium Controls
+    by a KD-tree (or a BallTree in high dimension) and only Controls above
+    'exact_max_control' rows are indexed by NNDescent. Small and medium
+    segments thus get exact matches without graph construction. The trees
+    and the grid need dense features, so 'sparse' Controls are searched by
+    brute force in their place, also when they are named.
+    """
+
+    if engine != 'auto':
+        return 'brute' if sparse and engine in DENSE_ENGINES else engine
+
+    limits = dict(ENGINE_THRESHOLDS, **(thresholds or {}))
+
+    if n_control <= limits['brute_max_control']:
+        return 'brute'
+    if n_control <= limits['exact_max_control']:
+        if sparse:
+            return 'brute'
+        return 'kd_tree' if n_dim <= limits['kd_tree_max_dim'] else 'ball_tree'
+    return 'nndescent'
+
+
+def build_index(data, engine='auto', thresholds=None, n_neighbors_tree=None, n_jobs=-1, tiers=None, grid=None):
+    """Builds the search index of a Control slice with the selected engine.
+
+    NNDescent takes its parameters from nndescent_params, with 'tiers'
+    overriding NNDESCENT_TIERS. An 'n_jobs' of -1 uses the CPUs of the
+    container, see sem_runtime. The grid engine takes the keyword arguments
+    of GridIndex from 'grid'; it is only used when named.
+    """
+
+    engine = select_engine(data.shape[0], data.shape[1], engine=engine, thresholds=thresholds, sparse=sp.issparse(data))
+    if n_jobs == -1:
+        n_jobs = sem_runtime.threads()
+    print("{datetime}\tBuilding '{engine}' index over {n_control} Control rows...".format(datetime=datetime.now(tz), engine=engine, n_control=data.shape[0]))
+
+    return MATCH_ENGINES[engine](data, n_neighbors_tree=n_neighbors_tree, n_jobs=n_jobs, tiers=tiers, grid=grid)
+
+
+def _cache_read(path):
+    """Returns the bytes stored at a local or 'gs://' path, or None."""
+
+    if path.startswith('gs://'):
+        bucket, name = path[len('gs://'):].split('/', 1)
+        blob = storage.Client().bucket(bucket).blob(name)
+        return blob.download_as_bytes() if blob.exists() else None
+
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _cache_write(path, payload):
+    """Stores bytes at a local or 'gs://' path."""
+
+    if path.startswith('gs://'):
+        bucket, name = path[len('gs://'):].split('/', 1)
+        storage.Client().bucket(bucket).blob(name).upload_from_string(payload)
+        return
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+
+def index_fingerprint(data, n_neighbors_tree=None, tiers=None):
+    """Returns the hash of a Control feature matrix and the NNDescent parameters."""
+
+    h = hashlib.sha1()
+    h.update(json.dumps({'shape': data.shape,
+                         'dtype': str(data.dtype),
+                         'params': nndescent_params(data.shape[0], data.shape[1], tiers=tiers, n_neighbors_tree=n_neighbors_tree),
+                         'pynndescent': pynndescent.__version__}, sort_keys=True).encode())
+    # Hashed a block of rows at a time, from the buffer of the array, so the
+    # features are not copied whole.
+    step = max(1, 2 ** 24 // max(1, data.shape[1] * data.dtype.itemsize))
+    for lo in range(0, data.shape[0], step):
+        h.update(memoryview(np.ascontiguousarray(data[lo:lo + step])))
+    return h.hexdigest()
+
+
+def cached_index(data, cache, n_neighbors_tree=None, n_jobs=-1, tiers=None):
+    """Loads the NNDescent index of a Control slice from the cache, or builds it.
+
+    Indexes are stored under 'location' (a local folder or 'gs://' path),
+    keyed by index_fingerprint, so an index is reused only for the very
+    same Control features.
+
+    Returns:
+        tuple: the index and the position in data of each index row, or
+        None when the rows are in the order of data
+    """
+
+    location = cache['location'].rstrip('/')
+    fingerprint = index_fingerprint(data, n_neighbors_tree, tiers=tiers)
+    path = '{}/{}.pkl'.format(location, fingerprint)
+
+    payload = _cache_read(path)
+    if payload is not None:
+        print("{datetime}\tLoaded cached index {fingerprint}.".format(datetime=datetime.now(tz), fingerprint=fingerprint))
+        cached = pickle.loads(payload)
+        return cached['index'], cached['pos']
+
+    cached = {'index': build_index(data, engine='nndescent', n_neighbors_tree=n_neighbors_tree, n_jobs=n_jobs, tiers=tiers), 'pos': None}
+
+    _cache_write(path, pickle.dumps(cached, protocol=4))
+    print("{datetime}\tCached index {fingerprint}.".format(datetime=datetime.now(tz), fingerprint=fingerprint))
+
+    return cached['index'], cached['pos']
+
+
+def _segment_index(data):
+    """Returns the index of a Control slice and the position of its rows."""
+
+    ctx = _SEGMENT_CONTEXT
+    engine = select_engine(data.shape[0], data.shape[1], engine=ctx['engine'], thresholds=ctx['engine_thresholds'], sparse=sp.issparse(data))
+
+    if engine == 'nndescent' and ctx['index_cache']:
+        return cached_index(data, ctx['index_cache'], n_neighbors_tree=ctx['n_neighbors_tree'], n_jobs=ctx['n_jobs'], tiers=ctx['nndescent_tiers'])
+
+    return build_index(data, engine=engine, n_neighbors_tree=ctx['n_neighbors_tree'], n_jobs=ctx['n_jobs'], tiers=ctx['nndescent_tiers'], grid=ctx['grid']), None
+
+
+def assign_without_replacement(cand_idx, cand_dst, taken=None):
+    """Greedily assigns every Target its closest Control not used yet.
+
+    The candidates of each Target are its k nearest Controls, sorted by
+    distance. A heap holds the next candidate of every Target; the closest
+    pair overall is popped and assigned if its Control is still free,
+    otherwise the Target's next candidate is pushed. This runs in
+    O(n k log n) without a dense distance matrix. 'taken' flags the
+    Controls already assigned to other Targets, which are skipped.
+
+    Returns:
+        tuple: assigned Control per Target (-1 when all its candidates are
+        used) and distances (NaN when unassigned)
+    """
+
+    n_t, k = cand_idx.shape
+    cand_idx_ = cand_idx.tolist()
+    cand_dst_ = cand_dst.tolist()
+
+    idx = np.full((n_t, 1), -1, dtype=np.int64)
+    dst = np.full((n_t, 1), np.nan, dtype=np.float32)
+
+    heap = [(cand_dst_[t][0], t, 0) for t in range(n_t)]
+    heapq.heapify(heap)
+    used = set()
+
+    while heap:
+        d, t, r = heapq.heappop(heap)
+        c = cand_idx_[t][r]
+        if c >= 0 and c not in used and (taken is None or not taken[c]):
+            used.add(c)
+            idx[t, 0] = c
+            dst[t, 0] = d
+        elif r + 1 < k:
+            heapq.heappush(heap, (cand_dst_[t][r + 1], t, r + 1))
+
+    return idx, dst
+
+
+def relax_segments(part, ladder=None, min_control=1, failed=None):
+    """Finds a coarser Control for the segments with too little Control.
+
+    Each rung of the 'ladder' maps categorical values to coarser groups,
+    e.g. {"cvm": {"HVHIGH": "HV", "HVMED": "HV"}}; a variable mapped to None
+    is dropped. A segment with fewer than 'min_control' Control rows is
+    matched against the Control of all segments that fall in its group on
+    the first rung giving at least 'min_control' rows, or else the entire
+    Control. The segments listed in 'failed', whose own index could not be
+    built, are relaxed the same way but need Control outside the segment.
+
+    Returns:
+        list: per segment, None to use its own Control, the tuple of segments
+        whose Control is used, or 'all' for the entire Control
+    """
+
+    n_c = part['c_end'] - part['c_start']
+    relaxed = [None] * len(n_c)
+    failed = set(failed or [])
+    small = [i for i in range(len(n_c)) if n_c[i] < min_control or i in failed]
+
+    for rung in (ladder or []):
+        if not small:
+            break
+        keys = part['keys'].copy()
+        for var, mapping in rung.items():
+            if var in keys.columns:
+                keys[var] = '' if mapping is None else keys[var].astype(object).map(mapping).fillna(keys[var].astype(object))
+        groups = keys.astype(str).agg('|'.join, axis=1).values
+        for i in list(small):
+            members = np.flatnonzero(groups == groups[i])
+            if n_c[members].sum() >= min_control and (i not in failed or len(members) > 1):
+                relaxed[i] = tuple(members.tolist())
+                small.remove(i)
+
+    for i in small:
+        relaxed[i] = 'all'
+
+    return relaxed
+
+
+def _relaxed_index(group):
+    """Returns the index over the Control of a group of segments, or of the
+    entire Control for 'all', and the position of its rows.
+
+    Each index is built once per process and kept in the context, so
+    segments sharing a group reuse it. Indexes built in the parent before
+    the pool starts are inherited by the forked workers. The seconds spent
+    building it are returned last, for the metrics of the segments.
+    """
+
+    ctx = _SEGMENT_CONTEXT
+    cache = ctx.setdefault('relaxed_indexes', {})
+
+    if group not in cache:
+        X_c = ctx['X_c']
+        if group == 'all':
+            print("{datetime}\tBuilding the fallback index over the entire Control...".format(datetime=datetime.now(tz)))
+            rows, data = None, X_c
+        else:
+            rows = np.concatenate([np.arange(ctx['c_start'][g], ctx['c_end'][g]) for g in group])
+            data = X_c[rows]
+        s = time.time()
+        tree = build_index(data, engine=ctx['engine'], thresholds=ctx['engine_thresholds'], n_neighbors_tree=ctx['n_neighbors_tree'], n_jobs=ctx['n_jobs'], tiers=ctx['nndescent_tiers'], grid=ctx['grid'])
+        cache[group] = (tree, rows, data.shape[0], time.time() - s)
+
+    return cache[group]
+
+
+def read_match_state(path):
+    """Returns the match state saved at a local or 'gs://' path, or None."""
+
+    payload = _cache_read(path)
+    if payload is None:
+        return None
+    return pq.read_table(BytesIO(payload)).to_pandas()
+
+
+def write_match_state(path, state):
+    """Saves the match state as Parquet at a local or 'gs://' path."""
+
+    buffer = BytesIO()
+    pq.write_table(pa.Table.from_pandas(state, preserve_index=False), buffer)
+    _cache_write(path, buffer.getvalue())
+
+
+def carry_forward_matches(prior, crn_t, seg_t, labels, X_t, crn_c, X_c, c_start, c_end, tolerance=0.01):
+    """Finds the Targets whose prior match still holds.
+
+    A prior match is carried forward when the Target is in a segment with the
+    same label as before, its features moved by at most 'tolerance' in every
+    variable, and the matched Control is still in the segment with features
+    within 'tolerance' of those it was matched on. The distance is computed
+    again from the current features.
+
+    Returns:
+        tuple: Targets to query, and the Control index and distance of the
+        carried matches (-1 and NaN elsewhere)
+    """
+
+    n_t = X_t.shape[0]
+    carry_idx = np.full(n_t, -1, dtype=np.int64)
+    carry_dst = np.full(n_t, np.nan, dtype=np.float32)
+
+    t_vars = [x for x in prior.columns if x.startswith('t_')]
+    c_vars = [x for x in prior.columns if x.startswith('c_')]
+
+    if len(t_vars) != X_t.shape[1] or len(c_vars) != X_c.shape[1]:
+        print("{datetime}\tPrior match state has other features, matching all Targets.".format(datetime=datetime.now(tz)))
+        return np.ones(n_t, dtype=bool), carry_idx, carry_dst
+
+    prior = prior.drop_duplicates('crn', keep=False).set_index('crn').reindex(crn_t)
+
+    c_index = pd.Series(np.arange(crn_c.shape[0])).groupby(crn_c).first()
+    c_pos = c_index.reindex(prior['crn_0'].values).fillna(-1).to_numpy(dtype=np.int64)
+
+    valid = prior['label'].notna().values & (seg_t >= 0) & (c_pos >= 0)
+    seg = np.where(seg_t >= 0, seg_t, 0)
+    valid &= (prior['label'].values == np.asarray(labels, dtype=object)[seg])
+    valid &= (c_pos >= c_start[seg]) & (c_pos < c_end[seg])
+
+    valid &= (np.abs(X_t - prior[t_vars].to_numpy(dtype=np.float32)) <= tolerance).all(axis=1)
+    valid &= (np.abs(X_c[c_pos] - prior[c_vars].to_numpy(dtype=np.float32)) <= tolerance).all(axis=1)
+
+    carry_idx[valid] = c_pos[valid]
+    carry_dst[valid] = np.sqrt(((X_t[valid] - X_c[c_pos[valid]]) ** 2).sum(axis=1))
+
+    return ~valid, carry_idx, carry_dst
+
+
+def fit_projection(blocks, method='pca', n_components=8, seed=0, chunk_rows=1000000):
+    """Fits a linear projection of the features onto fewer dimensions.
+
+    'pca' takes the leading principal components of the pooled rows of all
+    'blocks' (dense or CSR), from their covariance accumulated a chunk at a
+    time. 'random' draws a sparse random projection, with entries of
+    +-sqrt(s / n_components) in one of every s = sqrt(n_dim) places.
+
+    Returns:
+        tuple: mean and projection matrix, applied by project_rows, and the
+        share of the variance kept (NaN for 'random')
+    """
+
+    n_dim = blocks[0].shape[1]
+    n_components = min(n_components, n_dim)
+
+    if method == 'random':
+        rng = np.random.default_rng(seed)
+        density = 1 / math.sqrt(n_dim)
+        W = rng.choice([-1.0, 0.0, 1.0], size=(n_dim, n_components), p=[density / 2, 1 - density, density / 2])
+        return np.zeros(n_dim, dtype=np.float32), (W / math.sqrt(density * n_components)).astype(np.float32), np.nan
+
+    if method != 'pca':
+        raise ValueError("Unknown projection method '{}'.".format(method))
+
+    n, total, gram = 0, np.zeros(n_dim), np.zeros((n_dim, n_dim))
+    for X in blocks:
+        for lo in range(0, X.shape[0], chunk_rows):
+            chunk = X[lo:lo + chunk_rows]
+            if sp.issparse(chunk):
+                gram += (chunk.T @ chunk).toarray()
+            else:
+                chunk = chunk.astype(np.float64)
+                gram += chunk.T @ chunk
+            total += np.asarray(chunk.sum(axis=0)).ravel()
+            n += chunk.shape[0]
+
+    mean = total / max(n, 1)
+    variance, vectors = np.linalg.eigh(gram / max(n, 1) - np.outer(mean, mean))
+    top = np.argsort(variance)[::-1][:n_components]
+    kept = variance[top].clip(0).sum() / max(variance.clip(0).sum(), 1e-12)
+
+    return mean.astype(np.float32), vectors[:, top].astype(np.float32), float(kept)
+
+
+def project_rows(X, mean, W, chunk_rows=1000000):
+    """Returns the rows of X (dense or CSR) projected by fit_projection."""
+
+    out = np.empty((X.shape[0], W.shape[1]), dtype=np.float32)
+    offset = mean @ W
+    for lo in range(0, X.shape[0], chunk_rows):
+        out[lo:lo + chunk_rows] = X[lo:lo + chunk_rows] @ W - offset
+    return out
+
+
+def pair_distances(X_t, X_c, idx):
+    """Returns the distances between the rows of X_t and the rows idx of X_c,
+    NaN where idx is -1."""
+
+    diff = X_t - X_c[np.maximum(idx, 0)]
+    if sp.issparse(diff):
+        dist = np.sqrt(np.asarray(diff.multiply(diff).sum(axis=1)).ravel())
+    else:
+        dist = np.sqrt((diff ** 2).sum(axis=1))
+    return np.where(idx >= 0, dist, np.nan).astype(np.float32)
+
+
+def _match_segment_blocks(i):
+    """Matches the Target of segment i to its Control, one block at a time.
+
+    Reads the sorted feature arrays from the module level context, so the
+    same function serves the sequential loop and the process pool. The
+    Target is queried in blocks of 'query_chunk_size' rows, so only one
+    block of neighbours is held at a time.
+
+    The sizes, timings and peak memory growth of the segment are recorded
+    in the 'stats' of the context, see SEGMENT_METRICS. A segment sharing
+    an index with others is charged an equal part of its build time.
+
+    Yields:
+        tuple: first and last position of the block in the sorted Target,
+        indices into the sorted Control and distances
+    """
+
+    ctx = _SEGMENT_CONTEXT
+    X_t, X_c = ctx['X_t'], ctx['X_c']
+
+    t_lo, t_hi = ctx['t_start'][i], ctx['t_end'][i]
+    c_lo, c_hi = ctx['c_start'][i], ctx['c_end'][i]
+
+    print("{datetime}\tStarting iteration {curitr} of {enditr}...".format(datetime=datetime.now(tz), curitr=i + 1, enditr=len(ctx['t_start'])))
+
+    chunk = ctx['query_chunk_size'] or t_hi - t_lo
+    todo = ctx['todo']
+
+    stats = ctx['stats'][i] = {'n_target': t_hi - t_lo,
+                               'n_queried': t_hi - t_lo if todo is None else int(todo[t_lo:t_hi].sum()),
+                               'n_control': c_hi - c_lo,
+                               'n_control_index': 0,
+                               'engine': None,
+                               'fallback': False,
+                               'build_s': 0.0,
+                               'query_s': 0.0,
+                               'rss_growth_mb': 0.0}
+    rss = _rss_mb()
+    peak_rss = _peak_rss_mb()
+
+    def rss_growth():
+        # The high-water mark of the process is the peak of this segment
+        # only if the segment raised it; else the resident memory sampled
+        # after the build and each block is the best estimate.
+        peak = _peak_rss_mb()
+        stats['rss_growth_mb'] = max(stats['rss_growth_mb'], (peak if peak > peak_rss else _rss_mb()) - rss)
+
+    if todo is not None and not todo[t_lo:t_hi].any():
+        print("{datetime}\tCarrying forward all prior matches of the segment.".format(datetime=datetime.now(tz)))
+        for lo in range(t_lo, t_hi, chunk):
+            hi = min(lo + chunk, t_hi)
+            yield lo, hi, ctx['carry_idx'][lo:hi, None], ctx['carry_dst'][lo:hi, None]
+        rss_growth()
+        return
+
+    s = time.time()
+    group = ctx['relaxed'][i]
+
+    if group is None:
+        try:
+            print("{datetime}\tUsing subset of Control...".format(datetime=datetime.now(tz)))
+            tree, pos = _segment_index(X_c[c_lo:c_hi])
+        except Exception as e:
+            # Matched again against a coarser Control once the other segments
+            # are done, see NNDescent_matching.
+            print("{datetime}\tUsing subset of Control was not successful ({error}). Relaxing the segment...".format(datetime=datetime.now(tz), error=e))
+            stats['failed'] = True
+            return
+    elif group != 'all':
+        print("{datetime}\tToo little Control in the segment. Using the Control of {n_segments} related segments...".format(datetime=datetime.now(tz), n_segments=len(group)))
+    else:
+        print("{datetime}\tToo little Control in the segment. Using the entire Control...".format(datetime=datetime.now(tz)))
+
+    shared_build_s = 0.0
+    if group is not None:
+        tree, pos, n_rows, shared_build_s = _relaxed_index(group)
+        c_lo, c_hi = 0, n_rows
+
+    stats.update(n_control_index=c_hi - c_lo,
+                 engine=select_engine(c_hi - c_lo, X_c.shape[1], engine=ctx['engine'], thresholds=ctx['engine_thresholds'], sparse=sp.issparse(X_c)),
+                 fallback=group is not None,
+                 build_s=time.time() - s + shared_build_s / max(1, sum(1 for x in ctx['relaxed'] if x == group)))
+    rss_growth()
+
+    print("{datetime}\tFinished building index.".format(datetime=datetime.now(tz)))
+
+    print("{datetime}\tPerforming Target-Control query...".format(datetime=datetime.now(tz)))
+    k = ctx['n_neighbors'] if ctx['replacement'] else min(max(ctx['wor_candidates'], 1), c_hi - c_lo)
+
+    def query(rows):
+        s = time.time()
+        matching = tree.query(rows, k=k)
+        stats['query_s'] += time.time() - s
+        rss_growth()
+        seg_idx = matching[0] if pos is None else np.where(matching[0] >= 0, pos[matching[0]], -1)
+        return np.where(seg_idx >= 0, seg_idx + c_lo, -1), matching[1]
+
+    blocks = []
+    for lo in range(t_lo, t_hi, chunk):
+        hi = min(lo + chunk, t_hi)
+        if todo is None:
+            seg_idx, seg_dst = query(X_t[lo:hi])
+        else:
+            # Only new or changed Targets are queried, the rest keep their prior match.
+            sel = np.flatnonzero(todo[lo:hi])
+            seg_idx = ctx['carry_idx'][lo:hi, None].copy()
+            seg_dst = ctx['carry_dst'][lo:hi, None].copy()
+            if sel.shape[0]:
+                seg_idx[sel], seg_dst[sel] = query(X_t[lo:hi][sel])
+        if ctx['replacement']:
+            yield lo, hi, seg_idx, seg_dst
+        else:
+            blocks.append((seg_idx, seg_dst))
+
+    print("{datetime}\tFinished Target-Control query.".format(datetime=datetime.now(tz)))
+
+    if not ctx['replacement']:
+        seg_idx, seg_dst = assign_without_replacement(np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks]), taken=ctx['taken'])
+        print("{datetime}\tAssigned Controls without replacement; {n_unmatched} Target(s) left unmatched.".format(datetime=datetime.now(tz), n_unmatched=int((seg_idx[:, 0] < 0).sum())))
+        rss_growth()
+        for lo in range(0, t_hi - t_lo, chunk):
+            yield t_lo + lo, t_lo + min(lo + chunk, t_hi - t_lo), seg_idx[lo:lo + chunk], seg_dst[lo:lo + chunk]
+
+
+def _match_segment(i):
+    """Matches the Target of segment i to its Control in one piece.
+
+    Returns:
+        tuple: segment number, indices into the sorted Control, distances
+        and the metrics of the segment
+    """
+
+    blocks = list(_match_segment_blocks(i))
+    if not blocks:
+        return i, None, None, _SEGMENT_CONTEXT['stats'][i]
+    return i, np.concatenate([b[2] for b in blocks]), np.concatenate([b[3] for b in blocks]), _SEGMENT_CONTEXT['stats'][i]
+
+
+def _segment_blocks(result):
+    """Splits the result of _match_segment into blocks of 'query_chunk_size'
+    rows, and keeps the metrics of a segment matched by a worker."""
+
+    i, seg_idx, seg_dst, stats = result
+    _SEGMENT_CONTEXT['stats'][i] = stats
+    if seg_idx is None:
+        return
+    t_lo = _SEGMENT_CONTEXT['t_start'][i]
+    chunk = _SEGMENT_CONTEXT['query_chunk_size'] or len(seg_idx)
+
+    for lo in range(0, len(seg_idx), chunk):
+        yield t_lo + lo, t_lo + min(lo + chunk, len(seg_idx)), seg_idx[lo:lo + chunk], seg_dst[lo:lo + chunk]
+
+
+def _peak_rss_mb():
+    """Returns the peak resident memory of the process in MB."""
+
+    # Linux reports kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.0 ** 10
+
+
+def _rss_mb():
+    """Returns the current resident memory of the process in MB, or the
+    peak where /proc is not available."""
+
+    # The second field of statm is the resident size in pages.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2.0 ** 20
+    except (IOError, OSError):
+        return _peak_rss_mb()
+
+
+# Columns of the segment metrics written as Prometheus gauges, with their
+# metric names and help texts.
+SEGMENT_METRICS = [('n_target', 'sem_segment_targets', 'Target rows of the segment.'),
+                   ('n_queried', 'sem_segment_queried_targets', 'Targets queried, the others kept their prior match.'),
+                   ('n_control', 'sem_segment_controls', 'Control rows of the segment.'),
+                   ('n_control_index', 'sem_segment_index_controls', 'Control rows of the index the segment was matched against.'),
+                   ('fallback', 'sem_segment_fallback', '1 if the segment was matched against the Control of other segments.'),
+                   ('build_s', 'sem_segment_build_seconds', 'Seconds building or loading the index; an index shared by several segments is charged to each in equal parts.'),
+                   ('query_s', 'sem_segment_query_seconds', 'Seconds querying the index.'),
+                   ('rss_growth_mb', 'sem_segment_rss_growth_megabytes', 'Largest growth of the resident memory of the process over its value at the start of the segment, sampled after the index build and each query block unless the segment raised the peak of the process.'),
+                   ('n_unmatched', 'sem_segment_unmatched_targets', 'Targets left without a match.'),
+                   ('dist_mean', 'sem_segment_dist_mean', 'Mean match distance.'),
+                   ('dist_p50', 'sem_segment_dist_p50', 'Median match distance.'),
+                   ('dist_p90', 'sem_segment_dist_p90', '90th percentile of the match distance.'),
+                   ('dist_p99', 'sem_segment_dist_p99', '99th percentile of the match distance.'),
+                   ('dist_max', 'sem_segment_dist_max', 'Largest match distance.')]
+
+
+def write_segment_metrics(report, path=None, prometheus=None, append=False):
+    """Writes the segment metrics of NNDescent_matching.
+
+    The metrics are written to 'path' as JSON records when it ends with
+    '.json', as CSV otherwise; with 'append', after the rows already there.
+    With 'prometheus', all rows are also written as gauges to that file, for
+    the textfile collector of the node exporter, labelled by segment.
+
+    Returns:
+        report (dataframe): metrics written, including appended rows
+    """
+
+    if path is not None:
+        if append and os.path.exists(path):
+            prior = pd.read_json(path, orient='records') if path.endswith('.json') else pd.read_csv(path)
+            report = pd.concat([prior, report], ignore_index=True, sort=False)
+        if path.endswith('.json'):
+            report.to_json(path, orient='records', indent=1)
+        else:
+            report.to_csv(path, index=False)
+
+    if prometheus is not None:
+        label = report['segment'].astype(str).str.replace('\\', '\\\\', regex=False).str.replace('"', '\\"', regex=False).str.replace('\n', '\\n', regex=False)
+        lines = []
+        for col, name, text in SEGMENT_METRICS:
+            lines += ['# HELP {} {}'.format(name, text), '# TYPE {} gauge'.format(name)]
+            for seg, value in zip(label, report[col].astype(float)):
+                if not np.isnan(value):
+                    lines.append('{}{{segment="{}"}} {!r}'.format(name, seg, float(value)))
+        # The collector may read at any time, so the file is replaced whole.
+        with open(prometheus + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(prometheus + '.tmp', prometheus)
+
+    return report
+
+
+class CsvMatchSink:
+    """Appends blocks of matches to a CSV file as soon as they are produced.
+
+    Attributes:
+        path (string): location of the CSV file
+        header (boolean): write the column names before the first block
+        columns (list): columns written when no block was produced
+    """
+
+    def __init__(self, path, header=True, columns=None):
+
+        self.path = path
+        self.header = header
+        self.columns = columns
+        self.rows = 0
+        self.started = False
+
+    def write(self, df):
+        df.to_csv(self.path, mode='a' if self.started else 'w', index=False, header=bool(self.header) and not self.started)
+        self.started = True
+        self.rows += df.shape[0]
+
+    def close(self):
+        if not self.started:
+            self.write(pd.DataFrame(columns=self.columns))
+        print("{datetime}\tWrote {rows} matched rows to '{path}'.".format(datetime=datetime.now(tz), rows=self.rows, path=self.path))
+
+
+class ParquetMatchSink:
+    """Appends blocks of matches to a Parquet file, one row group per block.
+
+    The CRN columns are written as strings, 'ref_dt' as a date and the
+    distances as doubles, so BigQuery loads the file with typed columns.
+
+    Attributes:
+        path (string): location of the Parquet file
+        columns (list): columns written
+        target_col_name (string): name of the CRN column
+    """
+
+    def __init__(self, path, columns, target_col_name='crn'):
+
+        self.path = path
+        self.columns = columns
+        self.target_col_name = target_col_name
+        self.rows = 0
+        self.writer = None
+
+    def _field(self, col, values):
+        if col == 'ref_dt':
+            return pa.array(pd.to_datetime(values).values.astype('datetime64[D]'), type=pa.date32())
+        if col.startswith('dist'):
+            return pa.array(np.asarray(values, dtype=np.float64), type=pa.float64())
+        if col == self.target_col_name or col.startswith(self.target_col_name + '_'):
+            values = pd.Series(values)
+            return pa.array(np.asarray(values.astype(str), dtype=object), type=pa.string(), mask=values.isna().values)
+        return pa.array(values)
+
+    def write(self, df):
+        table = pa.Table.from_arrays([self._field(col, df[col].values) for col in self.columns], names=self.columns)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.rows += df.shape[0]
+
+    def close(self):
+        if self.writer is None:
+            self.write(pd.DataFrame(columns=self.columns))
+        self.writer.close()
+        print("{datetime}\tWrote {rows} matched rows to '{path}'.".format(datetime=datetime.now(tz), rows=self.rows, path=self.path))
+
+
+# Options of the matching and their defaults, read from sem.json by
+# IncSales.match_frames, see match_options. Listed with the other optional
+# keys of sem.json in the README.
+MATCH_OPTIONS = {
+    # index of each segment: 'auto', or a name in MATCH_ENGINES, see select_engine
+    'engine': 'auto',
+    # sizes at which 'auto' switches engines, see ENGINE_THRESHOLDS
+    'engine_thresholds': None,
+    # NNDescent parameters by segment size, see NNDESCENT_TIERS
+    'nndescent_tiers': None,
+    # options of the grid engine, see GridIndex
+    'grid': None,
+    # 'location' ('gs://' or local folder) of reused NNDescent indexes, see cached_index,
+    # and 'ignore_vars' (['ref_dt']) left out of the segment labels match_state compares
+    'index_cache': None,
+    # Targets queried per block; with it the matches are streamed to the output
+    'query_chunk_size': None,
+    # 'csv', or 'parquet' to write row groups while matching
+    'out_format': 'csv',
+    # false gives every Target a distinct Control, see assign_without_replacement;
+    # Targets whose 'wor_candidates' are all taken stay unmatched
+    'replacement': True,
+    # nearest Controls considered per Target without replacement
+    'wor_candidates': 10,
+    # 'path' and 'tolerance' to carry forward unchanged matches, see carry_forward_matches
+    'match_state': None,
+    # caps the Control of oversized segments, see downsample_control
+    'control_sampling': None,
+    # 'ladder' and 'min_control' for segments with too little Control, see relax_segments
+    'relaxation': None,
+    # folder of memory-mapped features, best on a local disk
+    'memmap_dir': None,
+    # 'method' and 'n_components' to search on fewer dimensions, see fit_projection
+    'projection': None,
+    # keeps 'var_bsk' in sparse matrices, see sparse_rank_features
+    'sparse_bsk': False,
+    # 'path', 'prometheus' and 'append' of the segment metrics, see write_segment_metrics
+    'metrics': None,
+}
+
+
+def match_options(params=None, **options):
+    """Returns the options of the matching: MATCH_OPTIONS, updated with the
+    keys of 'params' (e.g. sem.json) that name an option and then with the
+    keyword arguments.
+
+    Raises:
+        ValueError: a keyword argument is not an option
+    """
+
+    unknown = sorted(set(options) - set(MATCH_OPTIONS))
+    if unknown:
+        raise ValueError("Unknown match options: {}.".format(', '.join(unknown)))
+
+    result = dict(MATCH_OPTIONS)
+    result.update({k: v for k, v in (params or {}).items() if k in MATCH_OPTIONS})
+    result.update(options)
+    return result
+
+
 def NNDescent_matching(target=None,
                        control=None,
                        cat_vars=None,
                        num_vars=None,
                        n_neighbors=1,
-                       n_neighbors_tree=50,
+                       n_neighbors_tree=None,
                        target_col_name='crn',
-                       normalise_dist=True):
+                       normalise_dist=True,
+                       workers=1,
+                       features=None,
+                       sink=None,
+                       out_vars=None,
+                       n_jobs=None,
+                       options=None):
     """Perform Nearest Neighbor Descent.
 
     Combinations of the categorical variables are generated prior to matching
     to speed up the matching process. Instead of using the entire Control,
     only those in Control matching a particular combination of categorical
     variables are matched to the Target with these same categorical variables.
+
+    Target and Control are sorted once by their categorical codes, so that
+    each segment is a contiguous float32 slice of the feature arrays. The
+    matches are collected in preallocated arrays and joined back once.
+
+    With more than one worker, the segments are matched in forked processes,
+    largest segments first, reading the sorted features from memory shared
+    with the parent. 'n_jobs' sets the threads of each, see sem_runtime.
+
+    'features' takes the Target and Control feature matrices, e.g. from
+    percentile_rank_features, in place of the 'num_vars' columns. When a
+    'sink' is given, the 'out_vars' of each block of Targets are written to
+    it straight away and nothing is returned.
+
+    'options' (see match_options) choose the index engine, the Control of
+    each segment and what is kept of the run.
     """
 
+    opts = match_options(**(options or {}))
+    engine, engine_thresholds, nndescent_tiers, grid = opts['engine'], opts['engine_thresholds'], opts['nndescent_tiers'], opts['grid']
+    index_cache, query_chunk_size, match_state, memmap_dir = opts['index_cache'], opts['query_chunk_size'], opts['match_state'], opts['memmap_dir']
+    replacement, wor_candidates = opts['replacement'], opts['wor_candidates']
+    control_sampling, relaxation, projection, metrics = opts['control_sampling'], opts['relaxation'], opts['projection'], opts['metrics']
+
+    if not replacement and n_neighbors != 1:
+        raise ValueError("Matching without replacement needs n_neighbors=1.")
+
+    if cat_vars is None:
+        cat_vars = []
+
     if isinstance(cat_vars, str):
         cat_vars = [cat_vars]
         print(cat_vars)
@@ -118,62 +1260,557 @@ def NNDescent_matching(target=None,
         num_vars = [num_vars]
         print(num_vars)
 
-    cat_combined = target.groupby(cat_vars).size().reset_index().drop(0, axis=1)
-    print(cat_combined)
-    n_groups = cat_combined.shape[0]
+    workers = sem_runtime.worker_count(workers)
+
+    part = segment_partition(target, control, cat_vars)
+    print(part['keys'])
+    n_groups = len(part['t_start'])
+
+    if features is None:
+        features = (target[num_vars].to_numpy(dtype=np.float32), control[num_vars].to_numpy(dtype=np.float32))
+
+    if sp.issparse(features[0]):
+        if memmap_dir is not None or index_cache or match_state is not None:
+            print("{datetime}\tSparse features are kept in memory, without index cache or match state.".format(datetime=datetime.now(tz)))
+        memmap_dir, index_cache, match_state = None, None, None
+
+    spilled = []
+
+    def spill(source, rows):
+        spilled.append(os.path.join(memmap_dir, 'control_{}_{}.npy'.format(os.getpid(), len(spilled))))
+        return spill_rows(source, rows, spilled[-1])
+
+    X_t = features[0][part['t_order']]
+    X_c = features[1][part['c_order']] if memmap_dir is None else spill(features[1], part['c_order'])
+
+    if control_sampling is not None and n_groups:
+        keep, report = downsample_control(X_t, X_c, part, **{k: v for k, v in control_sampling.items() if k != 'report'})
+        sampled = report[report['n_control_kept'] < report['n_control']]
+        print("{datetime}\tSampled the Control of {n_sampled} segments down to {n_kept} of {n_control} rows.".format(datetime=datetime.now(tz), n_sampled=sampled.shape[0], n_kept=int(report['n_control_kept'].sum()), n_control=int(report['n_control'].sum())))
+        if sampled.shape[0]:
+            print(sampled)
+            print("{datetime}\tEstimated mean match distance {dist_full:.6f} with the full Control and {dist_sampled:.6f} with the sample.".format(datetime=datetime.now(tz), dist_full=sampled['dist_full'].mean(), dist_sampled=sampled['dist_sampled'].mean()))
+        if control_sampling.get('report'):
+            report.to_csv(control_sampling['report'], index=False)
+
+        offsets = np.concatenate([[0], np.cumsum(keep)])
+        part = dict(part, c_order=part['c_order'][keep], c_start=offsets[part['c_start']], c_end=offsets[part['c_end']])
+        X_c = X_c[keep] if memmap_dir is None else spill(X_c, np.flatnonzero(keep))
+
+    P_t, P_c = X_t, X_c
+    if projection is not None:
+        mean, W, kept = fit_projection([X_t, X_c], method=projection.get('method', 'pca'), n_components=projection.get('n_components', 8), seed=projection.get('seed', 0))
+        P_t, P_c = project_rows(X_t, mean, W), project_rows(X_c, mean, W)
+        print("{datetime}\tProjected {n_dim} features onto {n_components} components.".format(datetime=datetime.now(tz), n_dim=X_t.shape[1], n_components=W.shape[1]))
+        if not np.isnan(kept):
+            print("{datetime}\tThe components keep {kept:.1%} of the variance.".format(datetime=datetime.now(tz), kept=kept))
+
+    if sink is None:
+        idx = np.zeros((X_t.shape[0], n_neighbors), dtype=np.int64)
+        dst = np.zeros((X_t.shape[0], n_neighbors), dtype=np.float32)
+
+    parallel = workers > 1 and n_groups > 1 and 'fork' in multiprocessing.get_all_start_methods()
+
+    crn_c = control[target_col_name].to_numpy()[part['c_order']]
+
+    ignore_vars = (index_cache or {}).get('ignore_vars', ['ref_dt'])
+    labels = part['keys'].drop(columns=[x for x in ignore_vars if x in cat_vars]).astype(str).agg('|'.join, axis=1).tolist()
+
+    t_cols = [x for x in target.columns if out_vars is None or x in out_vars]
+    f_cols = [j for j, x in enumerate(num_vars) if x not in target.columns and (out_vars is None or x in out_vars)]
+    dist_scale = len(num_vars) ** 0.5 if normalise_dist else 1.0
+
+    def match_frame(lo, hi, blk_idx, blk_dst):
+        df = target.iloc[part['t_order'][lo:hi]][t_cols].reset_index(drop=True)
+        for j in f_cols:
+            df[num_vars[j]] = X_t[lo:hi, j].toarray().ravel() if sp.issparse(X_t) else X_t[lo:hi, j]
+        for col in range(n_neighbors):
+            ids = crn_c[blk_idx[:, col]]
+            if (blk_idx[:, col] < 0).any():
+                ids = ids.astype(object)
+                ids[blk_idx[:, col] < 0] = None
+            df[target_col_name + '_' + str(col)] = ids
+        for col in range(n_neighbors):
+            df['dist_' + str(col)] = blk_dst[:, col] / dist_scale
+        return df if out_vars is None else df[out_vars]
+
+    todo, carry_idx, carry_dst = None, None, None
+
+    if match_state is not None and (n_neighbors != 1 or not replacement):
+        print("{datetime}\tMatch state needs n_neighbors=1 with replacement, matching all Targets.".format(datetime=datetime.now(tz)))
+        match_state = None
+
+    if match_state is not None:
+        crn_t = target[target_col_name].to_numpy()[part['t_order']]
+        seg_t = np.full(X_t.shape[0], -1, dtype=np.int64)
+        if n_groups:
+            seg_t[part['t_start'][0]:part['t_end'][-1]] = np.repeat(np.arange(n_groups), part['t_end'] - part['t_start'])
+        match_t = np.full(X_t.shape[0], -1, dtype=np.int64)
+
+        prior = read_match_state(match_state['path'])
+        if prior is not None:
+            todo, carry_idx, carry_dst = carry_forward_matches(prior, crn_t, seg_t, labels, X_t, crn_c, X_c, part['c_start'], part['c_end'], tolerance=match_state.get('tolerance', 0.01))
+            print("{datetime}\tCarrying forward {n_carry} prior matches, querying {n_todo} Targets.".format(datetime=datetime.now(tz), n_carry=int((~todo).sum()), n_todo=int(todo.sum())))
+            del prior
+
+    relaxed = relax_segments(part, ladder=(relaxation or {}).get('ladder'), min_control=(relaxation or {}).get('min_control', 1))
+
+    _SEGMENT_CONTEXT.update(X_t=P_t,
+                            X_c=P_c,
+                            t_start=part['t_start'],
+                            t_end=part['t_end'],
+                            c_start=part['c_start'],
+                            c_end=part['c_end'],
+                            n_neighbors=n_neighbors,
+                            n_neighbors_tree=n_neighbors_tree,
+                            nndescent_tiers=nndescent_tiers,
+                            grid=grid,
+                            n_jobs=n_jobs or sem_runtime.threads(workers if parallel else 1),
+                            engine=engine,
+                            engine_thresholds=engine_thresholds,
+                            index_cache=index_cache,
+                            query_chunk_size=query_chunk_size,
+                            replacement=replacement,
+                            wor_candidates=wor_candidates,
+                            todo=todo,
+                            carry_idx=carry_idx,
+                            carry_dst=carry_dst,
+                            relaxed=relaxed,
+                            relaxed_indexes={},
+                            taken=None if replacement else np.zeros(P_c.shape[0], dtype=bool),
+                            stats={})
+
+    seg_stats = []
+
+    pool = None
+
+    # Without replacement, segments matched against the Control of other
+    # segments are matched last, in the parent, so they skip the Controls
+    # the segments with their own Control have taken.
+    shared = [] if replacement else [i for i in range(n_groups) if relaxed[i] is not None]
+
+    try:
+        # Build the indexes shared by several segments once, before any
+        # worker is forked.
+        for group in sorted(set(x for x in relaxed if x is not None), key=str):
+            _relaxed_index(group)
+
+        if parallel:
+            print("{datetime}\tMatching {n_groups} segments with {workers} workers...".format(datetime=datetime.now(tz), n_groups=n_groups, workers=workers))
+            seg_size = (part['t_end'] - part['t_start']) + (part['c_end'] - part['c_start'])
+            seg_order = np.argsort(-seg_size, kind='stable')
+
+            # Forking is safe as sem_runtime selects the workqueue threading
+            # layer of numba. A small NNDescent index built here compiles the
+            # numba kernels in the parent, so the forked workers do not
+            # compile them again.
+            nndescent = [i for i in seg_order if relaxed[i] is None and select_engine(part['c_end'][i] - part['c_start'][i], P_c.shape[1], engine=engine, thresholds=engine_thresholds, sparse=sp.issparse(P_c)) == 'nndescent']
+            if nndescent:
+                sample = P_c[part['c_start'][nndescent[-1]]:part['c_end'][nndescent[-1]]][:2000]
+                build_index(sample, engine='nndescent', n_jobs=_SEGMENT_CONTEXT['n_jobs']).query(sample[:1], k=1)
+
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+            futures = [pool.submit(_match_segment, i) for i in seg_order if i not in shared]
+            results = (f.result() for f in as_completed(futures))
+            segments = ((r[0], _segment_blocks(r)) for r in results)
+        else:
+            segments = ((i, _match_segment_blocks(i)) for i in range(n_groups) if i not in shared)
+
+        failed = []
+
+        def relaxed_retry():
+            # Segments whose own index failed to build go through the
+            # relaxation ladder; their indexes are built here, once, in the
+            # parent.
+            if failed:
+                retry = relax_segments(part, ladder=(relaxation or {}).get('ladder'), min_control=(relaxation or {}).get('min_control', 1), failed=failed)
+                for i in failed:
+                    relaxed[i] = retry[i]
+                for group in sorted(set(relaxed[i] for i in failed), key=str):
+                    _relaxed_index(group)
+            for i in shared + failed:
+                yield i, _match_segment_blocks(i)
+
+        def all_segments():
+            yield from segments
+            yield from relaxed_retry()
+
+        done = 0
+        for i, blocks in all_segments():
+            seg_dst = []
+            for lo, hi, blk_idx, blk_dst in blocks:
+                if _SEGMENT_CONTEXT['taken'] is not None:
+                    _SEGMENT_CONTEXT['taken'][blk_idx[blk_idx[:, 0] >= 0, 0]] = True
+                if projection is not None:
+                    blk_dst = np.column_stack([pair_distances(X_t[lo:hi], X_c, blk_idx[:, col]) for col in range(blk_idx.shape[1])])
+                if metrics is not None:
+                    seg_dst.append(np.where(blk_idx[:, 0] >= 0, blk_dst[:, 0], np.nan))
+                if match_state is not None:
+                    match_t[lo:hi] = blk_idx[:, 0]
+                if sink is None:
+                    idx[lo:hi] = blk_idx
+                    dst[lo:hi] = blk_dst
+                else:
+                    sink.write(match_frame(lo, hi, blk_idx, blk_dst))
+            if _SEGMENT_CONTEXT['stats'][i].get('failed'):
+                failed.append(i)
+                continue
+            if metrics is not None:
+                seg_dst = np.concatenate(seg_dst).astype(np.float64) / dist_scale if seg_dst else np.zeros(0)
+                matched = seg_dst[~np.isnan(seg_dst)]
+                quantiles = np.percentile(matched, [50, 90, 99]) if matched.shape[0] else [np.nan] * 3
+                seg_stats.append(dict(_SEGMENT_CONTEXT['stats'][i],
+                                      segment=i,
+                                      n_unmatched=int(np.isnan(seg_dst).sum()),
+                                      dist_mean=matched.mean() if matched.shape[0] else np.nan,
+                                      dist_p50=quantiles[0],
+                                      dist_p90=quantiles[1],
+                                      dist_p99=quantiles[2],
+                                      dist_max=matched.max() if matched.shape[0] else np.nan))
+            done += 1
+            print("{datetime}\tProgress: {curseg}/{endseg} segments processed.".format(datetime=datetime.now(tz), curseg=done, endseg=n_groups))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        _SEGMENT_CONTEXT.clear()
+        # The mapped arrays stay readable after their files are removed.
+        for path in spilled:
+            os.remove(path)
+
+    if metrics is not None and seg_stats:
+        report = pd.DataFrame(seg_stats).sort_values('segment')
+        keys = part['keys'].reset_index(drop=True).iloc[report['segment']].reset_index(drop=True)
+        report = pd.concat([keys, report.reset_index(drop=True)], axis=1)
+        report['segment'] = keys.astype(str).agg('|'.join, axis=1).tolist() if keys.shape[1] else 'all'
+        report = report[['segment'] + [x for x in report.columns if x != 'segment']]
+        write_segment_metrics(report, path=metrics.get('path'), prometheus=metrics.get('prometheus'), append=metrics.get('append', False))
+        cost = report.assign(total_s=report['build_s'] + report['query_s']).sort_values('total_s', ascending=False)
+        print("{datetime}\tMost expensive segments:".format(datetime=datetime.now(tz)))
+        print(cost[['segment', 'n_target', 'n_control_index', 'engine', 'fallback', 'build_s', 'query_s', 'rss_growth_mb', 'dist_p50']].head(5).to_string(index=False))
+
+    if match_state is not None:
+        matched = (seg_t >= 0) & (match_t >= 0)
+        state = pd.DataFrame({'crn': crn_t[matched],
+                              'label': np.asarray(labels, dtype=object)[seg_t[matched]],
+                              'crn_0': crn_c[match_t[matched]]})
+        for j, var in enumerate(num_vars):
+            state['t_' + var] = X_t[matched, j]
+        for j, var in enumerate(num_vars):
+            state['c_' + var] = X_c[match_t[matched], j]
+        write_match_state(match_state['path'], state)
+        print("{datetime}\tSaved match state of {n_rows} Targets.".format(datetime=datetime.now(tz), n_rows=state.shape[0]))
+        del state
+
+    if sink is not None:
+        return None
+
+    # Targets without a segment are sorted to the front and are not matched.
+    lo, hi = (part['t_start'][0], part['t_end'][-1]) if n_groups else (0, 0)
+
+    return match_frame(lo, hi, idx[lo:hi], dst[lo:hi])
+
+
+def spill_rows(source, rows, path, chunk_rows=1000000):
+    """Writes the given rows of a feature matrix to a memory-mapped .npy file.
+
+    The rows are copied a chunk at a time, each chunk read in file order,
+    so neither the source nor the result has to fit in memory.
+
+    Returns:
+        array: the rows, backed by the file at 'path'
+    """
 
-    df_out = pd.DataFrame()
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(rows.shape[0], source.shape[1]))
 
-    for i in range(n_groups):
-        print("{datetime}\tStarting iteration {curitr} of {enditr}...".format(datetime=datetime.now(tz), curitr=i + 1, enditr=n_groups))
+    for lo in range(0, rows.shape[0], chunk_rows):
+        chunk = rows[lo:lo + chunk_rows]
+        order = np.argsort(chunk, kind='stable')
+        block = np.empty((chunk.shape[0], source.shape[1]), dtype=np.float32)
+        block[order] = source[chunk[order]]
+        out[lo:lo + chunk.shape[0]] = block
 
-        entire_control = False
+    out.flush()
+    return out
 
-        cat_i = pd.DataFrame(columns=cat_vars)
-        cat_i.loc[0] = cat_combined.loc[i, :]
 
-        df_t_i = pd.merge(target, cat_i, how='inner', on=cat_vars).reset_index(drop=True)
-        df_c_i = pd.merge(control, cat_i, how='inner', on=cat_vars).reset_index(drop=True)
+class SpilledColumns:
+    """Numerical columns of a frame kept in a memory-mapped file.
+
+    The frame keeps its other columns and, in 'spill_row', the row of the
+    file holding the values of each of its rows, so filtered and reordered
+    copies of the frame still find their values.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.data = np.zeros((0, len(self.columns)), dtype=np.float32)
+
+    def read_csv(self, source, chunk_rows=1000000, **kwargs):
+        """Reads a CSV file a chunk at a time into the file and a frame of
+        the other columns. Columns missing from the CSV are not spilled."""
+
+        frames, n_rows = [], 0
+        with open(self.path, 'wb') as f:
+            for chunk in pd.read_csv(source, chunksize=chunk_rows, **kwargs):
+                if not frames:
+                    self.columns = [x for x in self.columns if x in chunk.columns]
+                chunk[self.columns].to_numpy(dtype=np.float32, na_value=np.nan).tofile(f)
+                frames.append(chunk.drop(columns=self.columns).assign(spill_row=np.arange(n_rows, n_rows + chunk.shape[0])))
+                n_rows += chunk.shape[0]
+
+        if n_rows:
+            self.data = np.memmap(self.path, dtype=np.float32, mode='r', shape=(n_rows, len(self.columns)))
+
+        return pd.concat(frames, ignore_index=True)
+
+    def column(self, df, col):
+        """Returns the values of a spilled column for the rows of df."""
+
+        return self.data[df['spill_row'].to_numpy(), self.columns.index(col)]
+
+    def close(self):
+        """Removes the file."""
+
+        self.data = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def frame_columns(df, spill=None):
+    """Returns the columns of df, including those spilled to 'spill'."""
+
+    return set(df.columns) | set(spill.columns if spill is not None else [])
 
-        try:
-            print("{datetime}\tUsing subset of Control...".format(datetime=datetime.now(tz)))
-            print("{datetime}\tPerforming NDD...".format(datetime=datetime.now(tz)))
-            tree = NNDescent(df_c_i[num_vars], n_neighbors=n_neighbors_tree, n_jobs=-1)
-        except:
-            print("{datetime}\tUsing subset of Control was not successful. Using the entire Control...".format(datetime=datetime.now(tz)))
-            entire_control = True
-            print("{datetime}\tPerforming NDD...".format(datetime=datetime.now(tz)))
-            tree = NNDescent(control[num_vars], n_neighbors=n_neighbors_tree, n_jobs=-1)
 
-        print("{datetime}\tFinished NDD.".format(datetime=datetime.now(tz)))
+def feature_matrix(target, control, num_vars, out=None, spilled=None):
+    """Copies the numerical variables of Target and Control, column by
+    column, into one float32 matrix, or 'out' when given. Variables not in
+    the frames are read from the SpilledColumns of 'spilled'.
 
-        print("{datetime}\tPerforming Target-Control query...".format(datetime=datetime.now(tz)))
-        matching = tree.query(df_t_i[num_vars], k=n_neighbors)
+    Returns:
+        array: Target rows followed by Control rows
+    """
+
+    spilled = spilled or (None, None)
+    n_t = target.shape[0]
+    X = np.empty((n_t + control.shape[0], len(num_vars)), dtype=np.float32) if out is None else out
+
+    for j, col in enumerate(num_vars):
+        for df, spill, rows in [(target, spilled[0], slice(0, n_t)), (control, spilled[1], slice(n_t, None))]:
+            if col in df.columns or spill is None:
+                X[rows, j] = df[col].to_numpy(dtype=np.float32, na_value=np.nan)
+            else:
+                X[rows, j] = spill.column(df, col)
+
+    return X
+
+
+def percentile_rank_features(target, control, num_vars, weights=None, out=None, spilled=None):
+    """Ranks the numerical variables of Target and Control together.
+
+    The variables are copied once into a single float32 matrix, see
+    feature_matrix, and replaced column by column with their percentile
+    rank over Target and Control, with ties averaged as in pandas'
+    rank(pct=True). Missing values get a rank of 0. The weights are then
+    applied in a single broadcast. The matrix is written to 'out' when
+    given, e.g. a memory-mapped array.
 
-        print("{datetime}\tFinished Target-Control query.".format(datetime=datetime.now(tz)))
+    Returns:
+        tuple: Target and Control features, as views of the same matrix
+    """
+
+    n_t = target.shape[0]
+    X = feature_matrix(target, control, num_vars, out=out, spilled=spilled)
+
+    for j in range(len(num_vars)):
+        values = X[:, j]
+        valid = ~np.isnan(values)
+        ordered = np.sort(values[valid])
+        lo = np.searchsorted(ordered, values[valid], side='left')
+        hi = np.searchsorted(ordered, values[valid], side='right')
+
+        values[valid] = (lo + hi + 1) / (2.0 * max(ordered.shape[0], 1))
+        values[~valid] = 0
+
+    if weights is not None:
+        for k in weights.keys():
+            print('Applying weight {} to variable {}.'.format(weights[k], k))
+        w = np.array([weights.get(x, 1) for x in num_vars], dtype=np.float32)
+        for lo in range(0, X.shape[0], 1000000):
+            X[lo:lo + 1000000] *= w
 
-        idx = pd.DataFrame(matching[0])
+    return X[:n_t], X[n_t:]
 
-        if entire_control:
-            for col in idx.columns:
-                df_t_i[target_col_name + '_' + str(col)] = list(control.loc[idx[col], target_col_name])
+
+def _nonzero(values):
+    """Returns the positions and float32 values of the non-zero, non-missing
+    entries of a column, without densifying a sparse column."""
+
+    if isinstance(values.dtype, pd.SparseDtype) and values.dtype.fill_value == 0:
+        pos = values.array.sp_index.to_int_index().indices
+        found = values.array.sp_values.astype(np.float32)
+    else:
+        found = values.to_numpy(dtype=np.float32, na_value=np.nan)
+        pos = np.arange(found.shape[0])
+
+    valid = (found != 0) & ~np.isnan(found)
+    return pos[valid], found[valid]
+
+
+def sparse_rank_features(target, control, var_dense, var_sparse, weights=None):
+    """Ranks the numerical variables as percentile_rank_features does, but
+    keeps the 'var_sparse' variables sparse.
+
+    The rank of every sparse variable is shifted by the rank of zero, so that
+    zero stays zero and only the non-zero values are stored. A constant shift
+    per variable leaves all distances, and thus the matches, unchanged.
+    Missing values of these variables count as zero. Sparse pandas columns,
+    e.g. from IncSales.gcs_to_df, are read without densifying them.
+
+    Returns:
+        tuple: Target and Control features as CSR matrices, the 'var_dense'
+        variables first
+    """
+
+    n_t = target.shape[0]
+    n = n_t + control.shape[0]
+    dense_t, dense_c = percentile_rank_features(target, control, var_dense, weights=weights)
+
+    rows, cols, ranks = [], [], []
+    for j, col in enumerate(var_sparse):
+        pos_t, values_t = _nonzero(target[col])
+        pos_c, values_c = _nonzero(control[col])
+        values = np.concatenate([values_t, values_c])
+
+        ordered = np.sort(values)
+        n_neg = np.searchsorted(ordered, 0, side='left')
+        n_zero = n - ordered.shape[0]
+        shift = np.where(values > 0, n_zero, 0)
+        lo = np.searchsorted(ordered, values, side='left') + shift
+        hi = np.searchsorted(ordered, values, side='right') + shift
+
+        rows.append(np.concatenate([pos_t, pos_c + n_t]))
+        cols.append(np.full(values.shape[0], j))
+        ranks.append(((lo + hi - 2 * n_neg - n_zero) / (2.0 * n) * (weights or {}).get(col, 1)).astype(np.float32))
+
+    X = sp.csr_matrix((np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.float32),
+                       (np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64),
+                        np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64))),
+                      shape=(n, len(var_sparse)), dtype=np.float32)
+
+    X_t = sp.hstack([sp.csr_matrix(dense_t), X[:n_t]], format='csr', dtype=np.float32)
+    X_c = sp.hstack([sp.csr_matrix(dense_c), X[n_t:]], format='csr', dtype=np.float32)
+    return X_t, X_c
+
+
+def rank_feature_sql(var_num, weights=None):
+    """Returns the SQL columns of the weighted percentile ranks per ref_dt.
+
+    Matches percentile_rank_features: the rank of a value is its average
+    rank among the non-null values of the week over their number, and nulls
+    get 0. The average rank is taken from the ascending and descending RANK,
+    since PERCENT_RANK gives (rank - 1) / (n - 1) and BigQuery cannot
+    partition by a FLOAT64 to count ties.
+    """
+
+    columns = []
+    for var in var_num:
+        window = "over (partition by ref_dt, {var} is null order by {var}{{}})".format(var=var)
+        columns.append("if({var} is null, 0, (rank() {asc} - rank() {desc} + count({var}) over (partition by ref_dt) + 1) / (2 * count({var}) over (partition by ref_dt))) * {weight} as {var}".format(
+            var=var, asc=window.format(''), desc=window.format(' desc'), weight=(weights or {}).get(var, 1)))
+
+    return '\n     , '.join(columns)
+
+
+def carried_columns(params, var_num):
+    """Returns the columns of 'var_cat' and 'out_vars' that the match input
+    of prepare_match_sem.sql carries as they are: not the ranked features
+    'var_num', nor the match columns such as 'crn_0' and 'dist_0'."""
+
+    columns = []
+    for x in list(params['var_cat']) + list(params.get('out_vars') or []):
+        if x not in ['flag', 'ref_dt', 'crn', 'cvm'] + var_num + columns and not re.match(r'(crn|dist)_[0-9]+$', x):
+            columns.append(x)
+
+    return columns
+
+
+def lsh_match_sql(var_num, segment_vars, weights=None, n_tables=8, n_projections=4, widths=(1.0, 4.0), bucket_size=32, seed=0, out_vars=None):
+    """Returns the arguments of match_lsh_sem.sql for the given features.
+
+    Every hash table cuts 'n_projections' random projections of the weighted
+    ranks into buckets. The buckets are sized per segment, so that a bucket
+    holds about 'bucket_size' of the segment's Control: a cell of a
+    standard deviations holds about a / (2 sqrt(pi)) of roughly normal
+    projections, so a is 2 sqrt(pi) (bucket_size / n_control) ** (1 /
+    n_projections), taking the ranks as uniform. A Target's candidates are
+    the Controls of its segment sharing its bucket in any of the 'n_tables'
+    tables, about n_tables * bucket_size of them. Only the Targets left
+    without any candidate are hashed again with buckets the next factor in
+    'widths' wider. The 'out_vars' of the Target, apart from the match
+    columns, are written along with its match.
+
+    Returns:
+        dictionary: SQL fragments by the name of their placeholder
+    """
+
+    rng = np.random.default_rng(seed)
+    w = np.array([(weights or {}).get(x, 1) for x in var_num], dtype=np.float64)
+    dist = 'sqrt({})'.format(' + '.join('pow(target.{var} - control.{var}, 2)'.format(var=x) for x in var_num))
+
+    hash_columns, levels = [], []
+    for level, width in enumerate(widths):
+        joins = []
+        for table in range(n_tables):
+            cells = []
+            for _ in range(n_projections):
+                r = rng.normal(size=len(var_num))
+                size = width * math.sqrt(((r * w) ** 2).sum() / 12.0)
+                projected = ' + '.join('{:.6f} * {}'.format(r_j, var) for r_j, var in zip(r, var_num))
+                cells.append("cast(floor(({projected}) / ({size:.6f} * cell) + {offset:.6f}) as string)".format(projected=projected, size=size, offset=rng.uniform()))
+            hash_columns.append("farm_fingerprint(concat({cells})) as h_{level}_{table}".format(cells=", ',', ".join(cells), level=level, table=table))
+
+            on = ' and '.join(['target.{var} = control.{var}'.format(var=x) for x in ['ref_dt'] + segment_vars] + ['target.h_{level}_{table} = control.h_{level}_{table}'.format(level=level, table=table)])
+            joins.append("select target.crn, target.ref_dt, control.crn as crn_0, {dist} as dist\n    from pending_{level} target\n    inner join control\n    on {on}".format(level=level, dist=dist, on=on))
+
+        if level == 0:
+            pending = "pending_0 as (\n    select *\n    from target\n)"
         else:
-            for col in idx.columns:
-                df_t_i[target_col_name + '_' + str(col)] = list(df_c_i.loc[idx[col], target_col_name])
+            pending = ("pending_{level} as (\n    select *\n    from pending_{prev} target\n    where not exists (\n"
+                       "        select 1\n        from candidates_{prev}\n        where candidates_{prev}.crn = target.crn\n        and candidates_{prev}.ref_dt = target.ref_dt\n    )\n)").format(level=level, prev=level - 1)
+        levels.append("{pending}\n,\ncandidates_{level} as (\n    {joins}\n)".format(pending=pending, level=level, joins='\n\n    union all\n    '.join(joins)))
 
-        dst = pd.DataFrame(matching[1], columns=['dist_' + str(x) for x in idx.columns])
-        df_t_i = pd.concat([df_t_i, dst], axis=1)
+    out_vars = [x for x in (out_vars or []) if x not in ['ref_dt', 'crn'] and not re.match(r'(crn|dist)_[0-9]+$', x)]
 
-        df_out = pd.concat([df_out, df_t_i], axis=0)
+    return {'segment_columns': ''.join('\n         , {}'.format(x) for x in segment_vars),
+            'carried_columns': ''.join('\n         , {}'.format(x) for x in out_vars if x not in segment_vars + var_num),
+            'output_columns': ''.join('\n     , target.{}'.format(x) for x in out_vars),
+            'segment_partition': ''.join(', {}'.format(x) for x in segment_vars),
+            'cell_size': '{:.6f} * pow({:.1f} / greatest(n_control, 1), {:.6f})'.format(2 * math.sqrt(math.pi), bucket_size, 1.0 / n_projections),
+            'feature_columns': '\n         , '.join(var_num),
+            'hash_columns': '\n         , '.join(hash_columns),
+            'candidate_levels': '\n,\n'.join(levels),
+            'candidates': '\n    union all\n    '.join('select * from candidates_{}'.format(x) for x in range(len(widths))),
+            'dist_scale': '{:.6f}'.format(math.sqrt(len(var_num)))}
 
-        print("{datetime}\tProgress: {curseg}/{endseg} segments processed.".format(datetime=datetime.now(tz), curseg=i + 1, endseg=n_groups))
 
-    if normalise_dist:
-        n_dim = len(num_vars)
-        for dist_i in dst.columns:
-            df_out[dist_i] = df_out[dist_i] / (n_dim ** 0.5)
+def feature_weights(weights, var_tpg, var_bsk):
+    """Spreads the 'tpg' and 'bsk' weights evenly over their variables.
+
+    Returns:
+        dictionary: weight per variable, or None without weights
+    """
 
-    return df_out
+    try:
+        w_tpg = weights['tpg']
+        w_bsk = weights['bsk']
+        weights_ = dict(zip(var_tpg + var_bsk, [w_tpg/len(var_tpg)]*len(var_tpg) + [w_bsk/len(var_bsk)]*len(var_bsk)))
+        print("{datetime}\t{method}\t\tWeights successfully set.".format(datetime=datetime.now(tz), method='match'))
+    except:
+        weights_ = None
+
+    return weights_
 
 
 def matching_prod(target=None,
@@ -188,8 +1825,34 @@ def matching_prod(target=None,
                   normalise_dist=True,
                   out_dir='./',
                   out_vars=None,
-                  out_table_header=None):
-    """Matches Target with Control."""
+                  out_table_header=None,
+                  workers=1,
+                  sink=None,
+                  prepared=False,
+                  segments=None,
+                  spilled=None,
+                  options=None):
+    """Matches Target with Control.
+
+    The segments are matched in 'workers' processes; a value below 1 uses
+    all available cores. 'options' are passed to NNDescent_matching, see
+    match_options. With 'query_chunk_size' or a Parquet 'out_format', the
+    matches are streamed to the output file and no match table is returned.
+    A 'sink' passed in receives the matches in place of the output file and
+    is left open, so several calls can write to one output.
+
+    With 'prepared', the numerical variables are already ranked and weighted,
+    e.g. by prepare_match_sem.sql, and are used as they are. 'spilled' holds
+    the SpilledColumns of Target and Control, whose numerical variables were
+    loaded to disk rather than into the frames.
+
+    With 'segments', e.g. one shard of plan_shards, only the rows of those
+    segments are matched. The features are ranked over all rows first, so
+    a shard is matched on the same features as the whole run.
+    """
+
+    options = match_options(**(options or {}))
+    memmap_dir, sparse_bsk = options['memmap_dir'], options['sparse_bsk']
 
     if var_bsk is None:
         var_bsk = []
@@ -198,47 +1861,275 @@ def matching_prod(target=None,
     if var_tpg is None:
         var_tpg = []
 
-    assert set(var_cat + var_tpg + var_bsk + [target_col_name]).issubset(target.columns)
-    assert set(var_cat + var_tpg + var_bsk + [target_col_name]).issubset(control.columns)
+    spilled = spilled or (None, None)
+    assert set(var_cat + var_tpg + var_bsk + [target_col_name]).issubset(frame_columns(target, spilled[0]))
+    assert set(var_cat + var_tpg + var_bsk + [target_col_name]).issubset(frame_columns(control, spilled[1]))
 
-    target['flag'] = 1
-    control['flag'] = 0
+    var_num = var_tpg + var_bsk
 
-    df = pd.concat([target, control], axis=0, sort=False)
+    features_path, out = None, None
+    if memmap_dir is not None and not sparse_bsk:
+        os.makedirs(memmap_dir, exist_ok=True)
+        features_path = os.path.join(memmap_dir, 'features_{}.npy'.format(os.getpid()))
+        out = np.lib.format.open_memmap(features_path, mode='w+', dtype=np.float32, shape=(target.shape[0] + control.shape[0], len(var_num)))
+
+    # The spilled features are removed also when ranking or matching fails.
+    try:
+        if prepared:
+            X = feature_matrix(target, control, var_num, out=out, spilled=spilled)
+            features = (X[:target.shape[0]], X[target.shape[0]:])
+        elif sparse_bsk:
+            features = sparse_rank_features(target, control, var_tpg, var_bsk, weights=weights)
+            print("{datetime}\tRanked {n_var} features into sparse matrices with {nnz} non-zero values.".format(datetime=datetime.now(tz), n_var=len(var_num), nnz=features[0].nnz + features[1].nnz))
+        else:
+            features = percentile_rank_features(target, control, var_num, weights=weights, out=out, spilled=spilled)
+
+        if segments is not None:
+            rows_t = np.flatnonzero(segment_mask(target, segments))
+            rows_c = np.flatnonzero(segment_mask(control, segments))
+            features = (features[0][rows_t], features[1][rows_c])
+            target = target.iloc[rows_t].reset_index(drop=True)
+            control = control.iloc[rows_c].reset_index(drop=True)
+            print("{datetime}\tMatching {n_segments} segments: {n_target} Target and {n_control} Control rows.".format(datetime=datetime.now(tz), n_segments=segments.shape[0], n_target=target.shape[0], n_control=control.shape[0]))
+
+        df_t_ = target[[target_col_name] + var_cat].reset_index(drop=True)
+        df_c_ = control[[target_col_name] + var_cat].reset_index(drop=True)
+
+        match_cols = list(df_t_.columns) + var_num + [target_col_name + '_' + str(x) for x in range(n_neighbors)] + ['dist_' + str(x) for x in range(n_neighbors)]
+
+        if out_vars is None:
+            out_vars = [x for x in match_cols if target_col_name in x or 'dist' in x or 'offer_nbr' in x]
+
+        own_sink = sink is None
+        if own_sink and options['out_format'] == 'parquet':
+            sink = ParquetMatchSink('{}{}'.format(out_dir, out_name), columns=out_vars, target_col_name=target_col_name)
+        elif own_sink and options['query_chunk_size']:
+            sink = CsvMatchSink('{}{}'.format(out_dir, out_name), header=out_table_header, columns=out_vars)
+
+        s = time.time()
+        print("{datetime}\tBegin matching...".format(datetime=datetime.now(tz)))
+        df_matched = NNDescent_matching(target=df_t_,
+                                        control=df_c_,
+                                        cat_vars=var_cat,
+                                        num_vars=var_num,
+                                        features=features,
+                                        n_neighbors=n_neighbors,
+                                        target_col_name=target_col_name,
+                                        normalise_dist=normalise_dist,
+                                        workers=workers,
+                                        sink=sink,
+                                        out_vars=out_vars if sink else None,
+                                        options=options)
+        e = time.time()
+    finally:
+        if features_path is not None:
+            os.remove(features_path)
 
-    var_num = var_tpg + var_bsk
+    print("{datetime}\tProcess time: {prctim:.2f} minutes".format(datetime=datetime.now(tz), prctim=(e - s) / 60))
 
-    for item in var_num:
-        df[item] = df[item].rank(pct=True).fillna(0)
+    if sink is not None:
+        if own_sink:
+            sink.close()
+        return None, (e - s) / 60
 
-    if weights is not None:
-        for k in weights.keys():
-            print('Applying weight {} to variable {}.'.format(weights[k], k))
-            df[k] = df[k] * weights[k]
+    print(df_matched.head())
+    df_matched[out_vars].to_csv('{}{}'.format(out_dir, out_name), index=False, header=out_table_header)
+
+    return df_matched, (e - s) / 60
+
+
+def match_balance(target, control, t_rows, c_rows, var_num):
+    """Returns the standardised mean difference of each variable between the
+    matched Targets and their Controls, and summaries of the match distance.
+
+    The difference of the means is divided by the pooled standard deviation
+    of the matched Target and Control.
+
+    Returns:
+        dictionary: 'smd_' per variable, mean and maximum absolute SMD
+    """
+
+    balance = {}
+    for var in var_num:
+        x_t = target[var].to_numpy(dtype=np.float64, na_value=np.nan)[t_rows]
+        x_c = control[var].to_numpy(dtype=np.float64, na_value=np.nan)[c_rows]
+        pooled = math.sqrt((np.nanvar(x_t) + np.nanvar(x_c)) / 2) if t_rows.shape[0] else np.nan
+        balance['smd_' + var] = (np.nanmean(x_t) - np.nanmean(x_c)) / pooled if pooled > 0 else 0.0
+
+    smd = np.abs(np.array(list(balance.values()), dtype=np.float64))
+    balance['smd_mean'] = float(np.nanmean(smd)) if smd.shape[0] else np.nan
+    balance['smd_max'] = float(np.nanmax(smd)) if smd.shape[0] else np.nan
+    return balance
+
+
+def _sweep_job(n):
+    """Matches with the n-th weight configuration of the sweep.
 
-    df_t_ = df.loc[df['flag'] == 1, [target_col_name] + var_cat + var_num].reset_index(drop=True)
-    df_c_ = df.loc[df['flag'] == 0, [target_col_name] + var_cat + var_num].reset_index(drop=True)
+    Reads the frames and the unweighted features from the module level
+    context, like _match_segment_blocks. The Targets and Controls are matched
+    by row number, so the matches index the frames directly.
 
+    Returns:
+        dictionary: weights, match counts, distance summaries and balance
+    """
+
+    ctx = _SWEEP_CONTEXT
+    config = ctx['configs'][n]
+    var_num = ctx['var_num']
+    weights = feature_weights(config, ctx['var_tpg'], ctx['var_bsk'])
+    w = np.array([(weights or {}).get(x, 1) for x in var_num], dtype=np.float32)
+
+    print("{datetime}\tMatching weight configuration {curcfg} of {endcfg}: {config}".format(datetime=datetime.now(tz), curcfg=n + 1, endcfg=len(ctx['configs']), config=config))
     s = time.time()
-    print("{datetime}\tBegin matching...".format(datetime=datetime.now(tz)))
-    df_matched = NNDescent_matching(target=df_t_,
-                                    control=df_c_,
-                                    cat_vars=var_cat,
-                                    num_vars=var_num,
-                                    n_neighbors=n_neighbors,
-                                    target_col_name=target_col_name,
-                                    normalise_dist=normalise_dist)
-    e = time.time()
+    df = NNDescent_matching(target=ctx['target'],
+                            control=ctx['control'],
+                            cat_vars=ctx['var_cat'],
+                            num_vars=var_num,
+                            features=(ctx['features'][0] * w, ctx['features'][1] * w),
+                            workers=1,
+                            n_jobs=ctx['n_jobs'],
+                            options=ctx['options'])
+
+    matched = df['crn_0'].notna().values
+    t_rows = df['crn'].to_numpy(dtype=np.int64)[matched]
+    c_rows = df['crn_0'].to_numpy(dtype=np.float64)[matched].astype(np.int64)
+    dist = df['dist_0'].to_numpy(dtype=np.float64)[matched]
+
+    result = {'config': n, 'weights': json.dumps(config, sort_keys=True),
+              'n_target': df.shape[0],
+              'n_matched': int(matched.sum()),
+              'n_distinct_control': int(np.unique(c_rows).shape[0]),
+              'dist_mean': float(dist.mean()) if dist.shape[0] else np.nan,
+              'dist_median': float(np.median(dist)) if dist.shape[0] else np.nan,
+              'dist_p90': float(np.quantile(dist, 0.9)) if dist.shape[0] else np.nan,
+              'minutes': (time.time() - s) / 60}
+    result.update(match_balance(ctx['raw_target'], ctx['raw_control'], t_rows, c_rows, var_num))
+    return result
+
+
+def weight_sweep(target=None, control=None, var_cat=None, var_tpg=None, var_bsk=None, configs=None, workers=1, options=None):
+    """Matches Target with Control once per weight configuration.
+
+    The features are ranked once, without weights, and every configuration
+    in 'configs' (dictionaries with 'tpg' and 'bsk', as 'weights' in
+    sem.json) only scales them. The configurations are matched in 'workers'
+    forked processes sharing the ranked features, as many as the CPUs and
+    memory of the container allow (see sem_runtime); the first one is matched
+    in the parent, so the numba kernels are compiled before forking.
+    'options' are passed to NNDescent_matching, see match_options.
+
+    Returns:
+        dataframe: one row per configuration with its match counts, distance
+        summaries and the balance of the matches, see match_balance
+    """
 
-    print("{datetime}\tProcess time: {prctim:.2f} minutes".format(datetime=datetime.now(tz), prctim=(e - s) / 60))
+    var_cat, var_tpg, var_bsk = var_cat or [], var_tpg or [], var_bsk or []
+    var_num = var_tpg + var_bsk
 
-    if out_vars is None:
-        out_vars = [x for x in df_matched.columns if target_col_name in x or 'dist' in x or 'offer_nbr' in x]
+    print("{datetime}\tRanking {n_var} features once for {n_config} weight configurations...".format(datetime=datetime.now(tz), n_var=len(var_num), n_config=len(configs)))
+    features = percentile_rank_features(target, control, var_num)
+
+    # Every job scales its own copy of the features.
+    workers = sem_runtime.worker_count(workers, memory_per_worker=2 * (features[0].nbytes + features[1].nbytes))
+
+    # Row numbers in place of the CRNs, so the matches index the frames.
+    df_t_ = target[var_cat].reset_index(drop=True).assign(crn=np.arange(target.shape[0]))
+    df_c_ = control[var_cat].reset_index(drop=True).assign(crn=np.arange(control.shape[0]))
+
+    _SWEEP_CONTEXT.update(target=df_t_,
+                          control=df_c_,
+                          raw_target=target,
+                          raw_control=control,
+                          features=features,
+                          var_cat=var_cat,
+                          var_tpg=var_tpg,
+                          var_bsk=var_bsk,
+                          var_num=var_num,
+                          configs=configs,
+                          n_jobs=sem_runtime.threads(min(workers, len(configs) - 1) if len(configs) > 1 else 1),
+                          options=options)
+
+    pool = None
+    try:
+        results = [_sweep_job(0)] if configs else []
+        if len(configs) > 1 and workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            pool = ProcessPoolExecutor(max_workers=min(workers, len(configs) - 1), mp_context=multiprocessing.get_context('fork'))
+            results += list(pool.map(_sweep_job, range(1, len(configs))))
+        else:
+            results += [_sweep_job(n) for n in range(1, len(configs))]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        _SWEEP_CONTEXT.clear()
 
-    print(df_matched.head())
-    df_matched[out_vars].to_csv('{}{}'.format(out_dir, out_name), index=False, header=out_table_header)
+    return pd.DataFrame(results)
 
-    return df_matched, (e - s) / 60
+
+def match_segment_vars(params):
+    """Returns the categorical variables the match is segmented on: 'var_cat'
+    without 'cvm' when 'encode_cvm' turns it into features (see
+    IncSales.prepare_frames)."""
+
+    return [x for x in params['var_cat'] if not (params['encode_cvm'] and x == 'cvm')]
+
+
+def plan_shards(sizes, n_shards=8):
+    """Splits the segments into shards of about equal matching cost.
+
+    The cost of a segment is its Target times its Control rows. Segments
+    are taken from the most to the least costly and each goes to the shard
+    with the least cost so far (longest processing time first). Segments
+    without Target are left out. A shard is matched on its own, so segments
+    relaxed to coarser Control (see relax_segments) only see the Control of
+    their shard.
+
+    Args:
+        sizes (dataframe): 'n_target' and 'n_control' per segment, with the
+            categorical variables of the segment in the other columns
+
+    Returns:
+        dataframe: the segments with their 'cost' and 'shard'
+    """
+
+    sizes = sizes[sizes['n_target'] > 0].copy()
+    sizes['cost'] = sizes['n_target'].astype(np.float64) * sizes['n_control'].astype(np.float64)
+    sizes = sizes.sort_values('cost', ascending=False, kind='stable').reset_index(drop=True)
+
+    heap = [(0.0, k) for k in range(max(1, min(n_shards, sizes.shape[0])))]
+    shard = np.zeros(sizes.shape[0], dtype=np.int64)
+    for i, cost in enumerate(sizes['cost'].values):
+        load, k = heapq.heappop(heap)
+        shard[i] = k
+        heapq.heappush(heap, (load + cost, k))
+
+    sizes['shard'] = shard
+    return sizes
+
+
+def write_shard_plan(path, cat_vars, plan):
+    """Saves the shard plan of plan_shards as JSON at a local or 'gs://' path."""
+
+    _cache_write(path, json.dumps({'cat_vars': cat_vars, 'segments': json.loads(plan.to_json(orient='records'))}).encode())
+
+
+def read_shard_plan(path):
+    """Returns the categorical variables and the segments of the shard plan
+    saved at a local or 'gs://' path by sem_shard_planner.py."""
+
+    plan = json.loads(_cache_read(path).decode())
+    return plan['cat_vars'], pd.DataFrame(plan['segments'])
+
+
+def segment_mask(df, segments):
+    """Returns the rows of df whose categorical values are those of one of
+    the segments, compared as strings."""
+
+    cat_vars = [x for x in segments.columns if x in df.columns]
+    if not cat_vars:
+        # A single segment, without categorical variables, holds every row.
+        return np.ones(df.shape[0], dtype=bool)
+    rows = pd.MultiIndex.from_frame(df[cat_vars].astype(str))
+    return rows.isin(pd.MultiIndex.from_frame(segments[cat_vars].astype(str)))
 
 
 class IncSales:
@@ -317,6 +2208,28 @@ class IncSales:
         
         query_job = client.query(sql)
         print(query_job.result())
+
+
+    def bq_to_df(self, project=None, credentials=None, sql=None):
+
+        """Function to run a BigQuery query into a Pandas Dataframe.
+
+        Args:
+            project (string): name of BigQuery project
+            credentials (string): file location of credentials in JSON
+            sql (string): SQL code
+
+        Returns:
+            dataframe: query results
+
+        """
+
+        client = bigquery.Client(project=project)
+
+        print("{datetime}\t{method}\tEntered 'bq_to_df' method.".format(datetime=datetime.now(tz), method='bq_to_df'))
+        print("{datetime}\t{method}\tProject set to '{project}'.".format(datetime=datetime.now(tz), method='bq_to_df', project=project))
+
+        return client.query(sql).to_dataframe()
     
     def bq_to_bq(self, project=None, dataset=None, table=None, credentials=None, sql=None):
         
@@ -448,7 +2361,7 @@ class IncSales:
         return
     
     
-    def gcs_to_bq(self, project=None, dataset=None, table=None, bucket=None, folder=None, filename=None, credentials=None):
+    def gcs_to_bq(self, project=None, dataset=None, table=None, bucket=None, folder=None, filename=None, credentials=None, source_format=None):
         
         """Function to load GCS file to BigQuery table.
         
@@ -458,8 +2371,10 @@ class IncSales:
             table (string): name of BigQuery table
             bucket (string): name of Google Cloud Storage bucket
             folder (string): name of Google Cloud Storage folder
-            filename (string): name of Google Cloud Storage file
+            filename (string or list): name of Google Cloud Storage file, or
+                names of files loaded together
             credentials (string): file location of credentials in JSON
+            source_format (string): 'CSV' (default) or 'PARQUET'
             
         Returns:
             None
@@ -467,7 +2382,10 @@ class IncSales:
         """
         
         table_path = project + '.' + dataset + '.' + table
-        source_uri = "gs://{}/{}/{}".format(bucket, folder, filename)
+        if isinstance(filename, list):
+            source_uri = ["gs://{}/{}/{}".format(bucket, folder, x) for x in filename]
+        else:
+            source_uri = "gs://{}/{}/{}".format(bucket, folder, filename)
         dataset_ref = bigquery.DatasetReference(project, dataset)
         table_ref = dataset_ref.table(table)
         
@@ -487,15 +2405,20 @@ class IncSales:
         dataset_ref = client.dataset(dataset)
         job_config = bigquery.LoadJobConfig()
         job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
-        job_config.schema = [
-            bigquery.SchemaField("ref_dt", "DATE"),
-            bigquery.SchemaField("crn", "STRING"),
-            bigquery.SchemaField("crn_0", "STRING"),
-            bigquery.SchemaField("dist_0", "FLOAT")
-        ]
-        job_config.skip_leading_rows = 1
 
-        job_config.source_format = bigquery.SourceFormat.CSV
+        if source_format == 'PARQUET':
+            # The column types are stored in the Parquet file.
+            job_config.source_format = bigquery.SourceFormat.PARQUET
+        else:
+            job_config.schema = [
+                bigquery.SchemaField("ref_dt", "DATE"),
+                bigquery.SchemaField("crn", "STRING"),
+                bigquery.SchemaField("crn_0", "STRING"),
+                bigquery.SchemaField("dist_0", "FLOAT")
+            ]
+            job_config.skip_leading_rows = 1
+
+            job_config.source_format = bigquery.SourceFormat.CSV
 
         load_job = client.load_table_from_uri(
             source_uri,
@@ -798,7 +2721,7 @@ class IncSales:
         
         return
     
-    def gcs_to_df(self, project=None, bucket=None, folder=None, filename=None, credentials=None):
+    def gcs_to_df(self, project=None, bucket=None, folder=None, filename=None, credentials=None, usecols=None, dtype=None, sparse=None, spill=None):
         
         """Function to load GCS file to local Pandas Dataframe.
         
@@ -808,6 +2731,14 @@ class IncSales:
             folder (string): name of Google Cloud Storage folder
             filename (string): name of Google Cloud Storage file
             credentials (string): file location of credentials in JSON
+            usecols (list or callable): columns to read, all by default
+            dtype (dictionary): column types
+            sparse (list): numerical columns stored as sparse float32 with a
+                fill value of 0; the file is then read in chunks, so these
+                columns are never dense in full
+            spill (SpilledColumns): numerical columns written to its file
+                rather than the frame; the file is then downloaded next to
+                it and read in chunks, so neither is held in memory
             
         Returns:
             None
@@ -826,10 +2757,28 @@ class IncSales:
         print("{datetime}\t{method}\tFilename set to '{filename}'.".format(datetime=datetime.now(tz), method='gcs_to_df', filename=filename))
 
         blob = client_bucket.blob(filepath)
-        byte_stream = BytesIO()
+        byte_stream = BytesIO() if spill is None else open(spill.path + '.csv', 'w+b')
         blob.download_to_file(byte_stream)
         byte_stream.seek(0)
-        df = pd.read_csv(byte_stream)
+
+        def read_csv(dtype_):
+            if spill is not None:
+                df_ = spill.read_csv(byte_stream, usecols=usecols, dtype=dtype_)
+            elif not sparse:
+                return pd.read_csv(byte_stream, usecols=usecols, dtype=dtype_)
+            else:
+                sparse_dtype = pd.SparseDtype(np.float32, 0)
+                chunks = [chunk.astype({x: sparse_dtype for x in sparse if x in chunk.columns}) for chunk in pd.read_csv(byte_stream, usecols=usecols, dtype=dtype_, chunksize=1000000)]
+                df_ = pd.concat(chunks, ignore_index=True)
+            # Chunks with other categories are concatenated as objects.
+            return df_.astype({k: v for k, v in (dtype_ or {}).items() if v == 'category' and k in df_.columns})
+
+        try:
+            df = read_csv(dtype)
+        finally:
+            if spill is not None:
+                byte_stream.close()
+                os.remove(spill.path + '.csv')
 
         print("{datetime}\t{method}\tReturned {filename}.".format(datetime=datetime.now(tz), method='gcs_to_df', filename=filename))
 
@@ -875,7 +2824,115 @@ class IncSales:
         return
     
     
-    def match(self, project=None, bucket=None, folder=None, filename=None, credentials=None, target=None, control=None, match=None, params=None):
+    def prepare_match_input(self, project=None, dataset=None, bucket=None, folder=None, params=None, credentials=None, export=True):
+
+        """Function to prepare the match features in BigQuery.
+        The Target and Control tables are filtered, CVM encoded and ranked by
+        'prepare_match_sem.sql' into the 'match_input' table, which is
+        exported to GCS for 'match' with 'sql_features' set. The columns of
+        'var_cat' and 'out_vars' are carried along, see carried_columns.
+
+        Args:
+            project (string): name of BigQuery project
+            dataset (string): name of BigQuery dataset
+            bucket (string): name of Google Cloud Storage bucket
+            folder (string): name of Google Cloud Storage folder
+            params (dictionary): parameters used for matching process
+            credentials (string): file location of credentials in JSON
+            export (boolean): export the table to GCS, not needed by
+                match_bigquery
+
+        Returns:
+            None
+
+        """
+
+        var_tpg_ = list(params['var_tpg'])
+        var_bsk_ = list(params['var_bsk'])
+        if params['encode_cvm'] and 'cvm' in params['var_cat']:
+            var_bsk_ += ['CVM_value', 'CVM_SOW']
+
+        weights_ = feature_weights(params.get('weights'), var_tpg_, var_bsk_)
+        table = params.get('match_input', 'prepare_match_sem')
+
+        sql_args = {'dam-project': project, 'dam-dataset': dataset, 'target': params['target'], 'control': params['control'], 'rank_columns': rank_feature_sql(var_tpg_ + var_bsk_, weights_),
+                    'carried_columns': ''.join('\n     , {}'.format(x) for x in carried_columns(params, var_tpg_ + var_bsk_))}
+        sql = self.prepare_sql(loc=self.get_sql_query_location('prepare_match_sem'), sql_args=sql_args)
+
+        self.bq_to_bq(project=project, dataset=dataset, table=table, credentials=credentials, sql=sql)
+        if export:
+            self.bq_to_gcs(project=project, dataset=dataset, table=table, bucket=bucket, folder=folder, filename=table + '.csv', credentials=credentials)
+
+
+    def match_bigquery(self, project=None, dataset=None, params=None, credentials=None):
+
+        """Function to match Target and Control inside BigQuery.
+        The features are ranked by 'prepare_match_sem.sql' and the Targets
+        matched to their approximately nearest Control by 'match_lsh_sem.sql',
+        with the 'lsh' options in params (see lsh_match_sql), into the
+        'match' table. No data leaves BigQuery. Matching is with replacement.
+
+        Args:
+            project (string): name of BigQuery project
+            dataset (string): name of BigQuery dataset
+            params (dictionary): parameters used for matching process
+            credentials (string): file location of credentials in JSON
+
+        Returns:
+            out_table (None): the matches are in the 'match' table
+            t (float): process time
+
+        """
+
+        s = time.time()
+        self.prepare_match_input(project=project, dataset=dataset, params=params, credentials=credentials, export=False)
+
+        var_cat_ = [x for x in params['var_cat'] if x != 'ref_dt']
+        var_num = list(params['var_tpg']) + list(params['var_bsk'])
+        if params['encode_cvm'] and 'cvm' in var_cat_:
+            var_cat_.remove('cvm')
+            var_num += ['CVM_value', 'CVM_SOW']
+
+        weights_ = feature_weights(params.get('weights'), list(params['var_tpg']), var_num[len(params['var_tpg']):])
+        lsh = params.get('lsh') or {}
+        sql_args = lsh_match_sql(var_num, var_cat_, weights=weights_, n_tables=lsh.get('n_tables', 8), n_projections=lsh.get('n_projections', 4), widths=lsh.get('widths', [1.0, 4.0]), bucket_size=lsh.get('bucket_size', 32), seed=lsh.get('seed', 0), out_vars=params.get('out_vars'))
+        sql_args.update({'dam-project': project, 'dam-dataset': dataset, 'match_input': params.get('match_input', 'prepare_match_sem')})
+        sql = self.prepare_sql(loc=self.get_sql_query_location('match_lsh_sem'), sql_args=sql_args)
+
+        self.bq_to_bq(project=project, dataset=dataset, table=params['match'], credentials=credentials, sql=sql)
+
+        summary = self.bq_to_df(project=project, credentials=credentials, sql="select count(*) as n_target, countif(crn_0 is null) as n_unmatched, avg(dist_0) as dist_mean from `{}.{}.{}`".format(project, dataset, params['match']))
+        print(summary)
+
+        return None, (time.time() - s) / 60
+
+
+    def segment_sizes(self, project=None, dataset=None, params=None, credentials=None):
+
+        """Function to count the Target and Control rows of every segment,
+        the combinations of the variables of match_segment_vars, in BigQuery.
+
+        Args:
+            project (string): name of BigQuery project
+            dataset (string): name of BigQuery dataset
+            params (dictionary): parameters used for matching process
+            credentials (string): file location of credentials in JSON
+
+        Returns:
+            dataframe: segment variables, 'n_target' and 'n_control' per segment
+
+        """
+
+        var_seg = match_segment_vars(params)
+        segment_vars = ', '.join(var_seg)
+        sql_args = {'dam-project': project, 'dam-dataset': dataset, 'target': params['target'], 'control': params['control'], 'segment_vars': segment_vars,
+                    'segment_columns': ', '.join('cast({var} as string) as {var}'.format(var=x) for x in var_seg)}
+        sql = self.prepare_sql(loc=self.get_sql_query_location('segment_sizes_sem'), sql_args=sql_args)
+
+        return self.bq_to_df(project=project, credentials=credentials, sql=sql)
+
+
+    def match(self, project=None, bucket=None, folder=None, filename=None, credentials=None, target=None, control=None, match=None, params=None, workers=None, ref_dts=None, weight_sweep=None, segments=None, dataset=None):
         
         """Function to match Target and Control.
         'filename.csv' will be produced in the 'Output' folder.
@@ -890,6 +2947,20 @@ class IncSales:
             control (string): name of Control
             match (string): name of Match
             params (dictionary): parameters used for matching process
+            workers (int): number of processes matching segments in parallel,
+                defaults to 'workers' in params or 1
+            ref_dts (list): weeks to match one after another in this process,
+                'all' for every week in Target; the Target and Control files
+                are loaded once and the matches of all weeks are written to
+                one output
+            weight_sweep (list): weights to compare, each a dictionary like
+                'weights' in params; the files are loaded and ranked once and
+                only the report of sweep_frames is written
+            segments (dataframe): categorical values of the segments to
+                match, e.g. one shard of plan_shards; all by default
+            dataset (string): name of BigQuery dataset, for 'match_backend'
+                'bigquery', which matches in BigQuery into the 'match' table
+                (see match_bigquery) instead of loading the files
             
         Returns:
             out_table (dataframe): match table
@@ -901,50 +2972,194 @@ class IncSales:
         """Perform the matching. """
 
         print("{datetime}\t{method}\t\tEntered 'match' method.".format(datetime=datetime.now(tz), method='match'))
-        target = self.gcs_to_df(project=project, bucket=bucket, folder=folder, filename=target + '.csv', credentials=credentials)
-        control = self.gcs_to_df(project=project, bucket=bucket, folder=folder, filename=control + '.csv', credentials=credentials)
-        
-        print(target.head())
-        print(control.head())
-        
 
+        if params.get('match_backend', 'local') == 'bigquery' and weight_sweep is None:
+            print("{datetime}\t{method}\t\tMatching in BigQuery...".format(datetime=datetime.now(tz), method='match'))
+            return self.match_bigquery(project=project, dataset=dataset, params=params, credentials=credentials)
+
+        usecols, dtype = None, None
+        var_num = params['var_tpg'] + params['var_bsk']
+        columns = set(['crn', 'ref_dt', 'offer_nbr'] + params['var_cat'] + var_num + (params['out_vars'] or []))
+        if params.get('typed_load', True):
+            usecols = lambda x: x in columns
+            # CRNs are strings in BigQuery; read as numbers they would lose
+            # leading zeros.
+            dtype = dict({'crn': str, 'cvm': 'category'}, **{x: 'float32' for x in var_num})
+
+        prepared = params.get('sql_features', False)
+        options = match_options(params)
+        sparse = params['var_bsk'] if options['sparse_bsk'] else None
+
+        # With 'memmap_dir', the numerical variables are loaded to files in
+        # that folder rather than the frames, so Control larger than memory
+        # can be matched. The weight sweep and sparse features keep them.
+        spilled = (None, None)
+        if options['memmap_dir'] and weight_sweep is None and not sparse:
+            os.makedirs(options['memmap_dir'], exist_ok=True)
+            if prepared:
+                spill = SpilledColumns(os.path.join(options['memmap_dir'], 'input_{}.f32'.format(os.getpid())), var_num + ['CVM_value', 'CVM_SOW'])
+                spilled = (spill, spill)
+            else:
+                spilled = tuple(SpilledColumns(os.path.join(options['memmap_dir'], '{}_{}.f32'.format(x, os.getpid())), var_num) for x in ['target', 'control'])
+
+        try:
+            if prepared:
+                columns = columns | set(['flag', 'CVM_value', 'CVM_SOW'])
+                dtype = dict(dtype or {}, flag='int8', CVM_value='float32', CVM_SOW='float32')
+                df = self.gcs_to_df(project=project, bucket=bucket, folder=folder, filename=params.get('match_input', 'prepare_match_sem') + '.csv', credentials=credentials, usecols=lambda x: x in columns, dtype=dtype, sparse=sparse, spill=spilled[0])
+                target = df[df['flag'].values == 1].drop(columns='flag').reset_index(drop=True)
+                control = df[df['flag'].values == 0].drop(columns='flag').reset_index(drop=True)
+                del df
+            else:
+                target = self.gcs_to_df(project=project, bucket=bucket, folder=folder, filename=target + '.csv', credentials=credentials, usecols=usecols, dtype=dtype, sparse=sparse, spill=spilled[0])
+                control = self.gcs_to_df(project=project, bucket=bucket, folder=folder, filename=control + '.csv', credentials=credentials, usecols=usecols, dtype=dtype, sparse=sparse, spill=spilled[1])
+
+            print(target.head())
+            print(control.head())
+
+            if weight_sweep is not None:
+                return self.sweep_frames(target=target, control=control, filename=filename, params=params, workers=workers, configs=weight_sweep, prepared=prepared)
+
+            if ref_dts is None:
+                return self.match_frames(target=target, control=control, filename=filename, params=params, workers=workers, prepared=prepared, segments=segments, spilled=spilled)
+
+            t_week = target['ref_dt'].astype(str)
+            c_week = control['ref_dt'].astype(str)
+            if ref_dts == 'all':
+                ref_dts = sorted(t_week.unique())
+
+            out_vars = params['out_vars'] or ['crn', 'crn_0', 'dist_0']
+            if options['out_format'] == 'parquet':
+                sink = ParquetMatchSink('{}{}'.format(params['out_dir'], filename), columns=out_vars, target_col_name='crn')
+            else:
+                sink = CsvMatchSink('{}{}'.format(params['out_dir'], filename), header=params['out_table_header_flag'], columns=out_vars)
+
+            t = 0
+            matched = False
+            for ref_dt in ref_dts:
+                print("{datetime}\t{method}\t\tMatching week {ref_dt}...".format(datetime=datetime.now(tz), method='match', ref_dt=ref_dt))
+                target_ = target[(t_week == str(ref_dt)).values].reset_index(drop=True)
+                control_ = control[(c_week == str(ref_dt)).values].reset_index(drop=True)
+                if target_.shape[0] == 0 or control_.shape[0] == 0:
+                    print("{datetime}\t{method}\t\tWARNING: No Target or Control in week {ref_dt}, skipping.".format(datetime=datetime.now(tz), method='match', ref_dt=ref_dt))
+                    continue
+                out = self.match_frames(target=target_, control=control_, filename=filename, params=params, workers=workers, sink=sink, prepared=prepared, append_metrics=matched, segments=segments, spilled=spilled)
+                if out is not None:
+                    t += out[1]
+                    matched = True
+
+            sink.close()
+            return None, t
+        finally:
+            for spill in set(x for x in spilled if x is not None):
+                spill.close()
+
+
+    def prepare_frames(self, target=None, control=None, params=None, prepared=False, spilled=None):
+
+        """Function to check the variables of Target and Control and prepare
+        their CVM, see 'match_frames'.
+
+        Args:
+            target (dataframe): Target
+            control (dataframe): Control
+            params (dictionary): parameters used for matching process
+            prepared (boolean): Target and Control come from prepare_match_sem.sql
+            spilled (tuple): SpilledColumns of Target and Control, see 'match'
+
+        Returns:
+            tuple: Target, Control and the categorical, 'tpg' and 'bsk'
+            variables to match on, or None if variables are missing
+
+        """
 
-        var_cat_ = params['var_cat']
-        var_tpg_ = params['var_tpg']
-        var_bsk_ = params['var_bsk']
+        var_cat_ = list(params['var_cat'])
+        var_tpg_ = list(params['var_tpg'])
+        var_bsk_ = list(params['var_bsk'])
 
-        if not set(var_cat_ + var_tpg_ + var_bsk_).issubset(target.columns):
-            missing_vars = ", ".join(list(set(var_cat_ + var_tpg_ + var_bsk_) - set(target.columns)))
+        spilled = spilled or (None, None)
+
+        if not set(var_cat_ + var_tpg_ + var_bsk_).issubset(frame_columns(target, spilled[0])):
+            missing_vars = ", ".join(list(set(var_cat_ + var_tpg_ + var_bsk_) - frame_columns(target, spilled[0])))
             print("{datetime}\t{method}\t\tERROR: {missing_vars} not found in Target.".format(datetime=datetime.now(tz), method='match', missing_vars=missing_vars))
-            return
+            return None
 
-        if not set(var_cat_ + var_tpg_ + var_bsk_).issubset(control.columns):
-            missing_vars = ", ".join(list(set(var_cat_ + var_tpg_ + var_bsk_) - set(control.columns)))
+        if not set(var_cat_ + var_tpg_ + var_bsk_).issubset(frame_columns(control, spilled[1])):
+            missing_vars = ", ".join(list(set(var_cat_ + var_tpg_ + var_bsk_) - frame_columns(control, spilled[1])))
             print("{datetime}\t{method}\t\tERROR: {missing_vars} not found in Control.".format(datetime=datetime.now(tz), method='match', missing_vars=missing_vars))
-            return
+            return None
+
+        if prepared:
+            print("{datetime}\t{method}\t\tFeatures were prepared in BigQuery.".format(datetime=datetime.now(tz), method='match'))
+            if params['encode_cvm'] and 'cvm' in var_cat_:
+                var_cat_.remove('cvm')
+                var_bsk_ += ['CVM_value', 'CVM_SOW']
+        elif 'cvm' in var_cat_:
+            exclude = []
+            for cvm in ['INACTIVE', 'LAPSED']:
+                if (cvm in target['cvm'].values):
+                    print("{datetime}\t{method}\t\tKeeping {cvm} in control...".format(datetime=datetime.now(tz), method='match', cvm=cvm))
+                else:
+                    print("{datetime}\t{method}\t\tExcluding {cvm} from control...".format(datetime=datetime.now(tz), method='match', cvm=cvm))
+                    exclude += [cvm, 'NA']
+
+            target = prepare_cvm(target, encode_cvm=params['encode_cvm'])
+            control = prepare_cvm(control, exclude=exclude, encode_cvm=params['encode_cvm'])
+
+            if params['encode_cvm']:
+                var_cat_.remove('cvm')
+                var_bsk_ += ['CVM_value', 'CVM_SOW']
+        else:
+            target, control, var_cat_, var_bsk_ = cvm_encoding_proc(target, control, encode_cvm=params['encode_cvm'], cat_vars=var_cat_, num_vars=var_bsk_)
 
-        if 'cvm' in var_cat_:
-            if ('INACTIVE' in target['cvm'].values):
-                print("{datetime}\t{method}\t\tKeeping INACTIVE in control...".format(datetime=datetime.now(tz), method='match'))
-            else:
-                print("{datetime}\t{method}\t\tExcluding INACTIVE from control...".format(datetime=datetime.now(tz), method='match'))
-                control = exclude_inactive(control)
+        return target, control, var_cat_, var_tpg_, var_bsk_
 
-            if ('LAPSED' in target['cvm'].values):
-                print("{datetime}\t{method}\t\tKeeping LAPSED in control...".format(datetime=datetime.now(tz), method='match'))
-            else:
-                print("{datetime}\t{method}\t\tExcluding LAPSED from control...".format(datetime=datetime.now(tz), method='match'))
-                control = exclude_lapsed(control)
 
-        target, control, var_cat_, var_bsk_ = cvm_encoding_proc(target, control, encode_cvm=params['encode_cvm'], cat_vars=var_cat_, num_vars=var_bsk_)
+    def match_frames(self, target=None, control=None, filename=None, params=None, workers=None, sink=None, prepared=False, append_metrics=False, segments=None, spilled=None):
 
-        try:
-            w_tpg = params['weights']['tpg']
-            w_bsk = params['weights']['bsk']
-            weights_ = dict(zip(var_tpg_ + var_bsk_, [w_tpg/len(var_tpg_)]*len(var_tpg_) + [w_bsk/len(var_bsk_)]*len(var_bsk_)))
-            print("{datetime}\t{method}\t\tWeights successfully set.".format(datetime=datetime.now(tz), method='match'))
-        except:
-            weights_ = None
+        """Function to match Target and Control dataframes, see 'match'.
+        The options of the matching are read from params, see match_options.
+        With 'segment_metrics' set to "csv" or "json" in params, the metrics
+        of every segment are written next to the match output, as 'filename'
+        with the suffix '_metrics.csv' or '_metrics.json', and to the
+        Prometheus textfile at 'metrics_textfile' in params, if set.
+
+        Args:
+            target (dataframe): Target
+            control (dataframe): Control
+            filename (string): name of output file
+            params (dictionary): parameters used for matching process
+            workers (int): number of processes matching segments in parallel
+            sink (object): open match output shared with other calls
+            prepared (boolean): Target and Control hold the ranked features
+                of prepare_match_sem.sql, so they are matched as they are
+            append_metrics (boolean): add the segment metrics to those of
+                an earlier call with the same 'filename'
+            segments (dataframe): categorical values of the segments to
+                match, ranked together with all other rows; all by default
+            spilled (tuple): SpilledColumns of Target and Control, see 'match'
+
+        Returns:
+            out_table (dataframe): match table
+            t (float): process time
+
+        """
+
+        frames = self.prepare_frames(target=target, control=control, params=params, prepared=prepared, spilled=spilled)
+        if frames is None:
+            return
+        target, control, var_cat_, var_tpg_, var_bsk_ = frames
+
+        weights_ = None if prepared else feature_weights(params.get('weights'), var_tpg_, var_bsk_)
+
+        metrics_ = None
+        if params.get('segment_metrics', False):
+            metrics_ = {'path': '{}{}_metrics.{}'.format(params['out_dir'], os.path.splitext(filename)[0], 'json' if params.get('segment_metrics') == 'json' else 'csv'),
+                        'prometheus': params.get('metrics_textfile'),
+                        'append': append_metrics}
+
+        if workers is None:
+            workers = params.get('workers', 1)
 
         print("{datetime}\t{method}\t\tPassing to the matching algorithm...".format(datetime=datetime.now(tz), method='match'))
 
@@ -960,12 +3175,68 @@ class IncSales:
                                                normalise_dist=True,
                                                out_dir=params['out_dir'],
                                                out_vars=params['out_vars'],
-                                               out_table_header=params['out_table_header_flag'])
+                                               out_table_header=params['out_table_header_flag'],
+                                               workers=workers,
+                                               sink=sink,
+                                               prepared=prepared,
+                                               segments=segments,
+                                               spilled=spilled,
+                                               options=match_options(params, metrics=metrics_))
 
         print("{datetime}\t{method}\t\tCompleted matching algorithm.".format(datetime=datetime.now(tz), method='match'))
         return out_table, t
     
     
+    def sweep_frames(self, target=None, control=None, filename=None, params=None, workers=None, configs=None, prepared=False):
+
+        """Function to match Target and Control once per weight configuration,
+        see weight_sweep. The report is written next to the match output, as
+        'filename' with the suffix '_sweep.csv'.
+
+        Args:
+            target (dataframe): Target
+            control (dataframe): Control
+            filename (string): name of output file
+            params (dictionary): parameters used for matching process
+            workers (int): number of weight configurations matched in parallel
+            configs (list): weights to try, dictionaries with 'tpg' and 'bsk'
+            prepared (boolean): Target and Control come from
+                prepare_match_sem.sql; ranking their weighted ranks again
+                gives the unweighted ranks
+
+        Returns:
+            report (dataframe): balance and distances per configuration
+            t (float): process time
+
+        """
+
+        frames = self.prepare_frames(target=target, control=control, params=params, prepared=prepared)
+        if frames is None:
+            return
+        target, control, var_cat_, var_tpg_, var_bsk_ = frames
+
+        if workers is None:
+            workers = params.get('workers', 1)
+
+        s = time.time()
+        report = weight_sweep(target=target,
+                              control=control,
+                              var_cat=var_cat_,
+                              var_tpg=var_tpg_,
+                              var_bsk=var_bsk_,
+                              configs=configs,
+                              workers=workers,
+                              options=match_options(params, index_cache=None, query_chunk_size=None, match_state=None, memmap_dir=None))
+        t = (time.time() - s) / 60
+
+        report_file = '{}{}_sweep.csv'.format(params['out_dir'], os.path.splitext(filename)[0])
+        report.to_csv(report_file, index=False)
+        print(report.to_string(index=False))
+        print("{datetime}\t{method}\t\tWrote the weight sweep report to {report_file}.".format(datetime=datetime.now(tz), method='match', report_file=report_file))
+
+        return report, t
+
+
     def plot_features(self, df=None, mode=None, save=None):
         
         """Function to plot features.
@@ -0,0 +1,234 @@
+import sem_runtime
+sem_runtime.configure()
+from datetime import datetime
+import argparse
+import json
+import math
+import multiprocessing
+import os
+from queue import Empty
+import resource
+import time
+import tracemalloc
+import pytz
+import numpy as np
+import pandas as pd
+
+from IncSalesGeneral import NNDESCENT_TIERS, ExactIndex, build_index, percentile_rank_features, segment_partition
+
+tz = pytz.timezone('Australia/Sydney')
+
+# Parameters of an NNDescent tier, see nndescent_params.
+TIER_PARAMS = ['n_neighbors', 'n_trees', 'max_candidates', 'epsilon']
+
+CVM_LEVELS = ['HVHIGH', 'HVMED', 'MVHIGH', 'MVMEDA', 'MVMEDB', 'LVHFA', 'LVHFB', 'LVLF', 'LVLFB', 'LOW']
+
+
+def synthetic_frames(n_control, n_target, n_segments, var_tpg, var_bsk, seed=0):
+    """Generates Target and Control with the columns of the SEM match input.
+
+    The segments are the combinations of 'cvm' and 'ref_dt': up to ten CVM
+    levels, then as many weeks as needed for 'n_segments'. Spends are
+    lognormal and scale with the CVM level; Target spends slightly more than
+    Control, as customers reached by SEM do.
+    """
+
+    rng = np.random.default_rng(seed)
+    n_cvm = min(n_segments, len(CVM_LEVELS))
+    n_weeks = int(math.ceil(n_segments / float(n_cvm)))
+    weeks = pd.date_range('2022-01-03', periods=n_weeks, freq='7D').strftime('%Y-%m-%d')
+
+    def frame(n, uplift):
+        cvm = rng.integers(0, n_cvm, n)
+        df = pd.DataFrame({'ref_dt': weeks[rng.integers(0, n_weeks, n)],
+                           'crn': rng.permutation(n) + 10 ** 9,
+                           'cvm': np.array(CVM_LEVELS)[cvm]})
+        level = (n_cvm - cvm) / float(n_cvm)
+        base = rng.lognormal(mean=3 + 2 * level, sigma=1, size=n)
+        for var in var_tpg:
+            df[var] = (base * rng.lognormal(mean=uplift, sigma=0.3, size=n)).astype(np.float32)
+        for var in var_bsk:
+            df[var] = (rng.random(n) < 0.3 + 0.5 * level) * rng.lognormal(mean=1, sigma=1, size=n).astype(np.float32)
+        return df
+
+    return frame(n_target, 0.1), frame(n_control, 0.0)
+
+
+def run_config(config, var_tpg, var_bsk, recall_sample, seed, queue, tiers=None, grid=None):
+    """Benchmarks one engine and parameter set on fresh synthetic data.
+
+    Runs in its own process, so the peak resident memory is that of this
+    configuration alone. Recall@1 is measured on a sample of Targets against
+    exact search over the same segment; a match counts when its distance is
+    no larger than the exact nearest distance. A configuration with a 'tier'
+    builds every segment with the parameters of that tier, whatever its size.
+    """
+
+    if 'tier' in config:
+        tiers = [dict({x: config[x] for x in TIER_PARAMS}, max_control=None)]
+
+    target, control = synthetic_frames(config['n_control'], config['n_target'], config['n_segments'], var_tpg, var_bsk, seed=seed)
+    var_num = var_tpg + var_bsk
+    weights = dict(zip(var_num, [0.5 / max(len(var_tpg), 1)] * len(var_tpg) + [0.5 / max(len(var_bsk), 1)] * len(var_bsk)))
+    X_t, X_c = percentile_rank_features(target, control, var_num, weights=weights)
+
+    part = segment_partition(target, control, ['ref_dt', 'cvm'])
+    X_t = X_t[part['t_order']]
+    X_c = X_c[part['c_order']]
+    del target, control
+
+    rng = np.random.default_rng(seed)
+    share = min(1.0, recall_sample / float(max(X_t.shape[0], 1)))
+
+    tracemalloc.start()
+    build_s, query_s, n_hit, n_checked, dist_ratio = 0.0, 0.0, 0, 0, []
+
+    for i in range(len(part['t_start'])):
+        t_lo, t_hi = part['t_start'][i], part['t_end'][i]
+        c_lo, c_hi = part['c_start'][i], part['c_end'][i]
+        if c_hi <= c_lo:
+            continue
+
+        s = time.time()
+        tree = build_index(X_c[c_lo:c_hi], engine=config['engine'], n_neighbors_tree=config['n_neighbors_tree'], tiers=tiers, grid=grid)
+        build_s += time.time() - s
+
+        s = time.time()
+        idx, dst = tree.query(X_t[t_lo:t_hi], k=1)
+        query_s += time.time() - s
+
+        sample = np.flatnonzero(rng.random(t_hi - t_lo) < share)
+        if sample.shape[0]:
+            _, exact = ExactIndex(X_c[c_lo:c_hi], algorithm='brute').query(X_t[t_lo:t_hi][sample], k=1)
+            n_hit += int((dst[sample, 0] <= exact[:, 0] * (1 + 1e-5) + 1e-7).sum())
+            n_checked += sample.shape[0]
+            dist_ratio.append(dst[sample, 0] / np.maximum(exact[:, 0], 1e-7))
+
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = dict(config)
+    result.update({'n_segments_found': len(part['t_start']),
+                   'build_s': round(build_s, 3),
+                   'query_s': round(query_s, 3),
+                   'recall_at_1': n_hit / float(n_checked) if n_checked else np.nan,
+                   'mean_dist_ratio': float(np.concatenate(dist_ratio).mean()) if dist_ratio else np.nan,
+                   'peak_traced_mb': round(peak_traced / 2 ** 20, 1),
+                   'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, 1)})
+    queue.put(result)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmarks the match engines on synthetic SEM data, offline.")
+
+    parser.add_argument(
+        "--sizes", type=str, default="10000,100000,1000000,10000000", help="Comma separated numbers of Control rows"
+    )
+    parser.add_argument(
+        "--segments", type=str, default="1,10,40", help="Comma separated numbers of segments"
+    )
+    parser.add_argument(
+        "--engines", type=str, default="nndescent,kd_tree", help="Comma separated engines, see MATCH_ENGINES"
+    )
+    parser.add_argument(
+        "--n-neighbors-tree", type=str, default="auto", help="Comma separated NNDescent graph degrees, 'auto' for the tiers by segment size"
+    )
+    parser.add_argument(
+        "--tiers", type=str, default=None, help="Compare whole NNDescent tiers at every size: 'default' for those of NNDESCENT_TIERS, or a JSON file with a list of tiers"
+    )
+    parser.add_argument(
+        "--target-recall", type=float, default=0.95, help="Recall@1 the fastest NNDescent configuration per size is reported for"
+    )
+    parser.add_argument(
+        "--target-ratio", type=float, default=0.1, help="Target rows per Control row"
+    )
+    parser.add_argument(
+        "--recall-sample", type=int, default=2000, help="Targets checked against exact search per configuration"
+    )
+    parser.add_argument(
+        "--config", type=str, default=None, help="sem.json to take 'var_tpg', 'var_bsk', 'nndescent_tiers' and 'grid' from"
+    )
+    parser.add_argument(
+        "--out", type=str, default="output/benchmark.csv", help="CSV file for the results"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the synthetic data"
+    )
+    args = parser.parse_args()
+
+    var_tpg, var_bsk = ['spend_8wk', 'spend_26wk'], ['bsk_1', 'bsk_2', 'bsk_3', 'bsk_4']
+    tiers, grid = None, None
+    if args.config is not None:
+        with open(args.config) as f:
+            spec = json.load(f)
+        var_tpg, var_bsk = spec.get('var_tpg', var_tpg), spec.get('var_bsk', var_bsk)
+        tiers = spec.get('nndescent_tiers')
+        grid = spec.get('grid')
+
+    candidates = None
+    if args.tiers == 'default':
+        candidates = NNDESCENT_TIERS
+    elif args.tiers is not None:
+        with open(args.tiers) as f:
+            candidates = json.load(f)
+
+    configs = []
+    for n_control in [int(float(x)) for x in args.sizes.split(',')]:
+        for n_segments in [int(x) for x in args.segments.split(',')]:
+            for engine in args.engines.split(','):
+                config = {'n_control': n_control,
+                          'n_target': max(int(n_control * args.target_ratio), 1),
+                          'n_segments': n_segments,
+                          'engine': engine,
+                          'n_neighbors_tree': None}
+                if engine == 'nndescent' and candidates is not None:
+                    for k, tier in enumerate(candidates):
+                        configs.append(dict(config, tier=k, **{x: tier.get(x) for x in TIER_PARAMS}))
+                    continue
+                for n_neighbors_tree in ([None if x == 'auto' else int(x) for x in args.n_neighbors_tree.split(',')] if engine in ('nndescent', 'auto') else [None]):
+                    configs.append(dict(config, n_neighbors_tree=n_neighbors_tree))
+
+    # Compile the numba kernels once, so the forked runs do not time the JIT.
+    # Forking is safe as sem_runtime selects the workqueue threading layer.
+    print("{datetime}\tWarming up...".format(datetime=datetime.now(tz)))
+    build_index(np.random.default_rng(0).random((500, len(var_tpg + var_bsk)), dtype=np.float32), engine='nndescent').query(np.zeros((1, len(var_tpg + var_bsk)), dtype=np.float32), k=1)
+
+    ctx = multiprocessing.get_context('fork')
+    results = []
+
+    for n, config in enumerate(configs):
+        print("{datetime}\tConfiguration {curcfg} of {endcfg}: {config}".format(datetime=datetime.now(tz), curcfg=n + 1, endcfg=len(configs), config=config))
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_config, args=(config, var_tpg, var_bsk, args.recall_sample, args.seed, queue, tiers, grid))
+        proc.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=5)
+            except Empty:
+                if not proc.is_alive():
+                    # The configuration died, most likely out of memory.
+                    result = dict(config, error='exit code {}'.format(proc.exitcode))
+        proc.join()
+        results.append(result)
+        print(result)
+
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        pd.DataFrame(results).to_csv(args.out, index=False)
+
+    print("{datetime}\tWrote {numres} results to {out}.".format(datetime=datetime.now(tz), numres=len(results), out=args.out))
+
+    # The cheapest NNDescent configuration per size that reaches the target
+    # recall is the one to put in the 'nndescent_tiers' of sem.json; with
+    # --tiers, its tier parameters are in the row.
+    df = pd.DataFrame(results)
+    if 'recall_at_1' in df.columns:
+        df = df[(df['engine'] == 'nndescent') & (df['recall_at_1'] >= args.target_recall)]
+        df = df.assign(total_s=df['build_s'] + df['query_s']).sort_values('total_s').drop_duplicates(['n_control', 'n_segments'])
+        print("Fastest NNDescent configurations with recall@1 >= {}:".format(args.target_recall))
+        print(df.sort_values(['n_control', 'n_segments']).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
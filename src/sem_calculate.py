@@ -1,3 +1,5 @@
+import sem_runtime
+sem_runtime.configure()
 from datetime import datetime
 import time
 import re
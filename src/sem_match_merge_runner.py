@@ -0,0 +1,85 @@
+import sem_runtime
+sem_runtime.configure()
+from datetime import datetime
+import argparse
+import re
+import sys
+import pytz
+import pandas as pd
+
+from IncSalesGeneral import read_shard_plan
+from IncSales import IncSalesSEM
+
+def check_format(date_,day):
+    try:
+        reg=r"[0-9]{4}[\-][0-9]{2}[\-][0-9]{2}"
+        match = re.search(reg,date_)
+        print(match.group())
+        check_date(date_,day)
+    except:
+
+        print("time data  " +date_+ "  does not match format '%y-%m-%d'")
+        sys.exit()
+
+
+def check_date(date_,day):
+    d=pd.to_datetime(date_)
+    weekday = d.date().weekday()
+    
+    if(weekday==0 and day=='mon'):
+            print("Entered Correct Date")
+    elif(weekday!=0 and day=='mon'):
+            print(" Please Enter Correct Date")
+            sys.exit()        
+    elif(weekday==6 and day=='sun'):
+            print("Entered Correct Date")
+    else:
+        print(" Please Enter Correct Date")
+        sys.exit()
+
+def check_env(env_):
+    try:
+        envs=['dev','prod']
+        if(env_ in envs):
+            print("Entered valid environment")
+        else:
+            print("Invalid Environment")
+            sys.exit()
+    except:
+        print("invalid env name")
+tz = pytz.timezone('Australia/Sydney')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Loads the outputs of all match shards into the match table.")
+
+    parser.add_argument(
+        "start_dt", type=str, help="Start Date: Monday of the previous week"
+    )
+    parser.add_argument(
+        "end_dt", type=str, help="End Date: Sunday of the previous week"
+    )
+    parser.add_argument(
+        "dataset", type=str, help="SQL file name"
+    )
+    parser.add_argument(
+        "env_dir", type=str, help="Environemnt Directory name"
+    )
+    args = parser.parse_args()
+    check_format(args.start_dt,'mon')
+    check_format(args.end_dt,'sun')
+    check_env(args.env_dir)
+    obj = IncSalesSEM(config='config/'+args.env_dir+'/sem.json',start_dt=args.start_dt, end_dt=args.end_dt, path = 'sql/sem/')
+
+    out_format = obj.spec.get('out_format', 'csv')
+    _, plan = read_shard_plan('gs://{}/{}/{}_shards.json'.format(obj.spec['bucket'], obj.spec['folder'], obj.spec['match']))
+
+    # Only the shards of this plan, not outputs left by earlier runs with more shards.
+    match_files = ['{}_shard{}.{}'.format(obj.spec['match'], k, out_format) for k in sorted(plan['shard'].unique())]
+    print("{datetime}\t{method}\tMerging {n_shards} match shards...".format(datetime=datetime.now(tz), method='automate', n_shards=len(match_files)))
+    obj.gcs_to_bq(project=obj.spec['project'], dataset=args.dataset, table=obj.spec['match'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=match_files, credentials="none", source_format=out_format.upper())
+
+
+if __name__ == "__main__":
+    main()
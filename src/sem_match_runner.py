@@ -1,14 +1,18 @@
+import sem_runtime
+sem_runtime.configure()
 from datetime import datetime
 import time
 import re
 import argparse
+import json
+import os
 import sys
 import pytz
 import pandas as pd
 
 
 from IncSales import IncSalesSEM
-from IncSalesGeneral import IncSales
+from IncSalesGeneral import IncSales, read_shard_plan
 from IncSales import IncSalesSEM
 
 def check_format(date_,day):
@@ -69,17 +73,64 @@ def main():
     parser.add_argument(
         "env_dir", type=str, help="Environemnt Directory name"
     )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes matching segments in parallel, 0 for all cores"
+    )
+    parser.add_argument(
+        "--ref-dts", type=str, default=None, help="Comma separated weeks (Mondays) to match in one run, or 'all' for every week in Target"
+    )
+    parser.add_argument(
+        "--shard", type=int, default=None, help="Shard of sem_shard_planner.py to match; its output is loaded by sem_match_merge_runner.py"
+    )
+    parser.add_argument(
+        "--weight-sweep", type=str, default=None, help="JSON file with a list of weights to compare, e.g. [{\"tpg\": 0.5, \"bsk\": 0.5}]; only the sweep report is written"
+    )
     args = parser.parse_args()
     check_format(args.start_dt,'mon')
     check_format(args.end_dt,'sun')
     check_env(args.env_dir)
+    ref_dts = args.ref_dts
+    if ref_dts is not None and ref_dts != 'all':
+        ref_dts = ref_dts.split(',')
+        for ref_dt in ref_dts:
+            check_format(ref_dt,'mon')
     obj = IncSalesSEM(config='config/'+args.env_dir+'/sem.json',start_dt=args.start_dt, end_dt=args.end_dt, path = 'sql/sem/')
 
     match = obj.spec['match']
+    out_format = obj.spec.get('out_format', 'csv')
+    match_file = obj.spec['match'] + '.' + out_format
+    segments = None
+    if obj.spec.get('match_backend', 'local') == 'bigquery' and args.weight_sweep is None:
+        # Matched in BigQuery straight into the match table, no files to load.
+        print("{datetime}\t{method}\tAutomating Match in BigQuery...".format(datetime=datetime.now(tz), method='automate'))
+        obj.match(project=obj.spec['project'], credentials="none", params=obj.spec, dataset=args.dataset)
+        return
+    if args.shard is not None:
+        cat_vars, plan = read_shard_plan('gs://{}/{}/{}_shards.json'.format(obj.spec['bucket'], obj.spec['folder'], obj.spec['match']))
+        segments = plan.loc[plan['shard'] == args.shard, cat_vars]
+        match_file = '{}_shard{}.{}'.format(obj.spec['match'], args.shard, out_format)
+        print("{datetime}\t{method}\tMatching shard {shard} of {n_segments} segments...".format(datetime=datetime.now(tz), method='automate', shard=args.shard, n_segments=segments.shape[0]))
+    elif obj.spec.get('sql_features', False):
+        print("{datetime}\t{method}\tPreparing match features in BigQuery...".format(datetime=datetime.now(tz), method='automate'))
+        obj.prepare_match_input(project=obj.spec['project'], dataset=args.dataset, bucket=obj.spec['bucket'], folder=obj.spec['folder'], params=obj.spec, credentials="none")
+    if args.weight_sweep is not None:
+        with open(args.weight_sweep) as f:
+            configs = json.load(f)
+        print("{datetime}\t{method}\tSweeping {n_config} weight configurations...".format(datetime=datetime.now(tz), method='automate', n_config=len(configs)))
+        obj.match(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=match_file, credentials="none", target=obj.spec['target'], control=obj.spec['control'], match=obj.spec['match'], params=obj.spec, workers=args.workers, weight_sweep=configs)
+        sweep_file = obj.spec['match'] + '_sweep.csv'
+        obj.local_to_gcs(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=sweep_file, loc='output/' + sweep_file, credentials="none")
+        return
     print("{datetime}\t{method}\tAutomating Match...".format(datetime=datetime.now(tz), method='automate'))
-    obj.match(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=obj.spec['match'] + '.csv', credentials="none", target=obj.spec['target'], control=obj.spec['control'], match=obj.spec['match'], params=obj.spec)
-    obj.local_to_gcs(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=obj.spec['match'] + '.csv', loc='output/' +obj.spec['match'] + '.csv', credentials="none")
-    obj.gcs_to_bq(project=obj.spec['project'], dataset=args.dataset, table=obj.spec['match'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=obj.spec['match'] + '.csv', credentials="none")
+    obj.match(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=match_file, credentials="none", target=obj.spec['target'], control=obj.spec['control'], match=obj.spec['match'], params=obj.spec, workers=args.workers, ref_dts=ref_dts, segments=segments)
+    obj.local_to_gcs(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=match_file, loc='output/' + match_file, credentials="none")
+    metrics_file = '{}_metrics.{}'.format(os.path.splitext(match_file)[0], 'json' if obj.spec.get('segment_metrics') == 'json' else 'csv')
+    if os.path.exists('output/' + metrics_file):
+        obj.local_to_gcs(project=obj.spec['project'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=metrics_file, loc='output/' + metrics_file, credentials="none")
+    if args.shard is not None:
+        # The shards are loaded together by sem_match_merge_runner.py.
+        return
+    obj.gcs_to_bq(project=obj.spec['project'], dataset=args.dataset, table=obj.spec['match'], bucket=obj.spec['bucket'], folder=obj.spec['folder'], filename=match_file, credentials="none", source_format=out_format.upper())
 
     
 
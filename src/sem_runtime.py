@@ -0,0 +1,137 @@
+"""Sizes the threads and processes of a run to the container it runs in.
+
+os.cpu_count() and the numba, OpenMP and BLAS defaults see every core of
+the node, not the CPU quota of the pod, and oversubscribe it. This module
+reads the cgroup CPU and memory limits and sets the thread counts of these
+libraries from them, and selects the fork safe threading layer of numba.
+It configures them when imported, and every runner imports it first and
+calls configure(), since the libraries read their settings when they are
+first imported.
+
+SEM_CPUS overrides the detected number of CPUs, up to the cores.
+"""
+
+from datetime import datetime
+import math
+import os
+import pytz
+import sys
+
+tz = pytz.timezone('Australia/Sydney')
+
+# Environment variables read by numba, OpenMP and the BLAS libraries.
+THREAD_VARS = ['NUMBA_NUM_THREADS',
+               'OMP_NUM_THREADS',
+               'OPENBLAS_NUM_THREADS',
+               'MKL_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS',
+               'NUMEXPR_NUM_THREADS']
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cpu_limit():
+    """Returns the CPU quota of the cgroup in CPUs, or None without a quota."""
+
+    # cgroup v2: "<quota> <period>", or "max <period>" without a quota.
+    value = _read('/sys/fs/cgroup/cpu.max')
+    if value is not None:
+        quota, period = value.split()[:2]
+        return None if quota == 'max' else int(quota) / float(period)
+
+    # cgroup v1: a quota of -1 means no quota.
+    quota = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') or _read('/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us')
+    period = _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us') or _read('/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us')
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / float(period)
+
+    return None
+
+
+def cgroup_memory_limit():
+    """Returns the memory limit of the cgroup in bytes, or None without a limit."""
+
+    value = _read('/sys/fs/cgroup/memory.max') or _read('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if value is None or value == 'max':
+        return None
+
+    # cgroup v1 reports no limit as a number near the largest 64-bit integer.
+    limit = int(value)
+    return None if limit >= 2 ** 60 else limit
+
+
+def cpu_budget():
+    """Returns the number of CPUs the process may use: the smallest of the
+    cores it may run on and SEM_CPUS if set, else the cgroup quota, at least
+    1. numba refuses more threads than cores, so SEM_CPUS cannot exceed them."""
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    if os.environ.get('SEM_CPUS'):
+        return max(1, min(cpus, int(os.environ['SEM_CPUS'])))
+
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, int(math.ceil(quota)))
+
+    return max(1, cpus)
+
+
+CPUS = cpu_budget()
+MEMORY = cgroup_memory_limit()
+
+
+def threads(workers=1):
+    """Returns the threads of each of 'workers' processes sharing the CPUs,
+    e.g. the n_jobs of NNDescent."""
+
+    return max(1, CPUS // max(1, workers))
+
+
+def worker_count(requested=None, memory_per_worker=None):
+    """Returns the number of worker processes to start.
+
+    A 'requested' number below 1 (or None) asks for one per CPU. The number
+    never exceeds the CPUs, nor, given the bytes each worker needs, the
+    memory limit.
+    """
+
+    workers = CPUS if requested is None or requested < 1 else min(requested, CPUS)
+    if MEMORY is not None and memory_per_worker:
+        workers = min(workers, max(1, int(MEMORY // memory_per_worker)))
+
+    return max(1, workers)
+
+
+_configured = False
+
+
+def configure():
+    """Sets the thread counts of numba, OpenMP and BLAS to the CPU budget,
+    unless they are set already. Only the first call has an effect."""
+
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    for var in THREAD_VARS:
+        os.environ.setdefault(var, str(CPUS))
+
+    # The segments and weight sweeps are matched in forked processes, and
+    # the TBB and OpenMP threading layers of numba are not fork safe. Numba
+    # picks its layer once, at the first parallel kernel, so the workqueue
+    # layer is selected here, before anything runs.
+    os.environ.setdefault('NUMBA_THREADING_LAYER', 'workqueue')
+    if 'numba' in sys.modules:
+        sys.modules['numba'].config.THREADING_LAYER = os.environ['NUMBA_THREADING_LAYER']
+
+    print("{datetime}\t{method}\tRunning with {cpus} CPUs and {memory} of memory.".format(datetime=datetime.now(tz), method='runtime', cpus=CPUS, memory='no limit' if MEMORY is None else '{:.1f} GB'.format(MEMORY / 2.0 ** 30)))
+
+
+configure()
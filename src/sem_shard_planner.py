@@ -0,0 +1,113 @@
+import sem_runtime
+sem_runtime.configure()
+from datetime import datetime
+import argparse
+import json
+import os
+import re
+import sys
+import pytz
+import pandas as pd
+
+from IncSalesGeneral import match_segment_vars, plan_shards, write_shard_plan
+from IncSales import IncSalesSEM
+
+def check_format(date_,day):
+    try:
+        reg=r"[0-9]{4}[\-][0-9]{2}[\-][0-9]{2}"
+        match = re.search(reg,date_)
+        print(match.group())
+        check_date(date_,day)
+    except:
+
+        print("time data  " +date_+ "  does not match format '%y-%m-%d'")
+        sys.exit()
+
+
+def check_date(date_,day):
+    d=pd.to_datetime(date_)
+    weekday = d.date().weekday()
+    
+    if(weekday==0 and day=='mon'):
+            print("Entered Correct Date")
+    elif(weekday!=0 and day=='mon'):
+            print(" Please Enter Correct Date")
+            sys.exit()        
+    elif(weekday==6 and day=='sun'):
+            print("Entered Correct Date")
+    else:
+        print(" Please Enter Correct Date")
+        sys.exit()
+
+def check_env(env_):
+    try:
+        envs=['dev','prod']
+        if(env_ in envs):
+            print("Entered valid environment")
+        else:
+            print("Invalid Environment")
+            sys.exit()
+    except:
+        print("invalid env name")
+tz = pytz.timezone('Australia/Sydney')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Splits the match segments into shards of about equal cost, for one sem_match_runner.py per shard.")
+
+    parser.add_argument(
+        "start_dt", type=str, help="Start Date: Monday of the previous week"
+    )
+    parser.add_argument(
+        "end_dt", type=str, help="End Date: Sunday of the previous week"
+    )
+    parser.add_argument(
+        "dataset", type=str, help="SQL file name"
+    )
+    parser.add_argument(
+        "env_dir", type=str, help="Environemnt Directory name"
+    )
+    parser.add_argument(
+        "--shards", type=int, default=8, help="Maximum number of shards"
+    )
+    parser.add_argument(
+        "--out", type=str, default="/tmp/shards.json", help="JSON list of the shards, for the withParam of the Argo fan out"
+    )
+    args = parser.parse_args()
+    check_format(args.start_dt,'mon')
+    check_format(args.end_dt,'sun')
+    check_env(args.env_dir)
+    obj = IncSalesSEM(config='config/'+args.env_dir+'/sem.json',start_dt=args.start_dt, end_dt=args.end_dt, path = 'sql/sem/')
+
+    if obj.spec.get('sql_features', False):
+        # Prepared once here, rather than by every shard.
+        print("{datetime}\t{method}\tPreparing match features in BigQuery...".format(datetime=datetime.now(tz), method='plan'))
+        obj.prepare_match_input(project=obj.spec['project'], dataset=args.dataset, bucket=obj.spec['bucket'], folder=obj.spec['folder'], params=obj.spec, credentials="none")
+
+    # With 'encode_cvm', the CVM is a feature and must not split the Control.
+    var_seg = match_segment_vars(obj.spec)
+    if var_seg:
+        print("{datetime}\t{method}\tCounting the segments of {var_seg}...".format(datetime=datetime.now(tz), method='plan', var_seg=', '.join(var_seg)))
+        sizes = obj.segment_sizes(project=obj.spec['project'], dataset=args.dataset, params=obj.spec, credentials="none")
+        plan = plan_shards(sizes, n_shards=args.shards)
+
+        cost = plan.groupby('shard')['cost'].sum()
+        print("{datetime}\t{method}\tPlanned {n_segments} segments in {n_shards} shards, the largest with {max_share:.1%} of the cost.".format(datetime=datetime.now(tz), method='plan', n_segments=plan.shape[0], n_shards=cost.shape[0], max_share=cost.max() / max(cost.sum(), 1)))
+        print(plan.groupby('shard')[['n_target', 'n_control', 'cost']].sum())
+    else:
+        print("{datetime}\t{method}\tNo segment variables to shard on, matching in one shard.".format(datetime=datetime.now(tz), method='plan'))
+        plan = pd.DataFrame({'shard': [0]})
+
+    # The plan is read by every shard and by the merge from GCS.
+    plan_path = 'gs://{}/{}/{}_shards.json'.format(obj.spec['bucket'], obj.spec['folder'], obj.spec['match'])
+    write_shard_plan(plan_path, var_seg, plan)
+    print("{datetime}\t{method}\tWrote the shard plan to {plan_path}.".format(datetime=datetime.now(tz), method='plan', plan_path=plan_path))
+
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump([{'shard': str(k)} for k in sorted(plan['shard'].unique())], f)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
 with base0 as (
-    select Date('{start_dt}') as ref_dt
+    select target.ref_dt
          ,target.crn
     from {dam-project}.{dam-dataset}.generate_target_sem target
     
     union distinct 
     
-    select  Date('{start_dt}') as ref_dt, crn
+    select  date_trunc(fw_start_date, isoweek) as ref_dt, crn
         from ``
         where date_trunc(fw_start_date, isoweek) between date('{start_dt}') and date('{end_dt}')
         group by 1,2
@@ -63,8 +63,8 @@ spend_8wk as (
     and lylty_card_detail.crn != '0'
     and article_sales_summary.division_nbr in (1005,1030)
     and article_sales_summary.void_flag = 'N'
-    -- changed the time interval to exclude the start_dt, moved start of windows back one day ( 57 instead of 56)
-    and article_sales_summary.start_txn_date between DATE_SUB('{start_dt}', INTERVAL 57 DAY) and DATE_SUB('{start_dt}', INTERVAL 1 DAY)    
+    -- changed the time interval to exclude the ref_dt, moved start of windows back one day ( 57 instead of 56)
+    and article_sales_summary.start_txn_date between DATE_SUB(base.ref_dt, INTERVAL 57 DAY) and DATE_SUB(base.ref_dt, INTERVAL 1 DAY)    
     group by 1,2
 )
 ,
@@ -82,9 +82,9 @@ spend_26wk as (
     and lylty_card_detail.crn != '0'
     and article_sales_summary.division_nbr in (1005,1030)
     and article_sales_summary.void_flag = 'N'
-    -- changed the time interval to exclude the start_dt, moved start of windows back one day ( 183 instead of 182)
-    and article_sales_summary.start_txn_date between DATE_SUB('{start_dt}', INTERVAL 183 DAY) 
-                                            and DATE_SUB('{start_dt}', INTERVAL 1 DAY)    
+    -- changed the time interval to exclude the ref_dt, moved start of windows back one day ( 183 instead of 182)
+    and article_sales_summary.start_txn_date between DATE_SUB(base.ref_dt, INTERVAL 183 DAY) 
+                                            and DATE_SUB(base.ref_dt, INTERVAL 1 DAY)    
     group by 1,2
 )
 select base.ref_dt
@@ -172,7 +172,8 @@ create table `{dam-project}.{dam-dataset}.sem_direct` as
 (
 
     
-    SELECT distinct date('{start_dt}') as date, a.crn 
+    -- the week of the purchase, so a range of weeks keeps one date per week
+    SELECT distinct date_trunc(date(e.start_txn_time), isoweek) as date, a.crn 
     from 
     (
         SELECT * from `{dam-project}.{dam-dataset}.sem_prod_clk` where productGroupId is not null
@@ -195,7 +196,8 @@ create table `{dam-project}.{dam-dataset}.sem_indirect` as
 (
 
     
-    SELECT distinct date('{start_dt}') as date, a.crn 
+    -- the week of the purchase, so a range of weeks keeps one date per week
+    SELECT distinct date_trunc(date(e.start_txn_time), isoweek) as date, a.crn 
     from 
     (
         SELECT * from `{dam-project}.{dam-dataset}.sem_prod_clk` where productGroupId is not null
@@ -211,6 +213,7 @@ create table `{dam-project}.{dam-dataset}.sem_indirect` as
             and timestamp_diff(e.start_txn_time, a.time_utc, DAY) between 0 and 7
     left join `{dam-project}.{dam-dataset}.sem_direct` direct
     on a.crn = direct.crn
+    and date_trunc(date(e.start_txn_time), isoweek) = direct.date
     where direct.crn is null
     
 );
@@ -219,7 +222,7 @@ create table `{dam-project}.{dam-dataset}.sem_indirect` as
 drop table if exists `{dam-project}.{dam-dataset}.sem_generic`;
 create table `{dam-project}.{dam-dataset}.sem_generic` as
 (
-    SELECT distinct date('{start_dt}') as date, a.crn
+    SELECT distinct date_trunc(date(b.start_txn_time), isoweek) as date, a.crn
     FROM
     (
         (
@@ -260,8 +263,10 @@ create table `{dam-project}.{dam-dataset}.sem_generic` as
                 
         left join `{dam-project}.{dam-dataset}.sem_direct` direct
         on a.crn = direct.crn
+        and date_trunc(date(b.start_txn_time), isoweek) = direct.date
         left join `{dam-project}.{dam-dataset}.sem_indirect` indirect
         on a.crn = indirect.crn
+        and date_trunc(date(b.start_txn_time), isoweek) = indirect.date
         
     ) where  direct.crn is null and indirect.crn is null
     
@@ -1,21 +1,22 @@
 with base as (
     -- group together the dates to the start of the week
+    -- every week between start_dt and end_dt, one ref_dt per week
 select date as ref_dt
          , direct.crn
     from {dam-project}.{dam-dataset}.sem_direct  direct
-    where  direct.date = date('{start_dt}')
+    where  direct.date between date('{start_dt}') and date('{end_dt}')
     
     union distinct 
     select distinct date as ref_dt
          , indirect.crn
     from {dam-project}.{dam-dataset}.sem_indirect  indirect
-    where  indirect.date = date('{start_dt}')
+    where  indirect.date between date('{start_dt}') and date('{end_dt}')
     
     union distinct
     select distinct date as ref_dt
          , generic.crn
     from {dam-project}.{dam-dataset}.sem_generic  generic
-    where  generic.date = date('{start_dt}')
+    where  generic.date between date('{start_dt}') and date('{end_dt}')
 )
 ,
 cvm as (
@@ -38,8 +39,8 @@ spend_8wk as (
         inner join base
         on  base.crn = lylty_card_detail.crn
         where article_sales_summary.lylty_card_nbr != '0'
-        -- changed the time interval to exclude the start_dt, moved start of windows back one day ( 57 instead of 56)
-        and article_sales_summary.start_txn_date between DATE_SUB('{start_dt}', INTERVAL 57 DAY) and DATE_SUB('{start_dt}', INTERVAL 1 DAY)
+        -- changed the time interval to exclude the ref_dt, moved start of windows back one day ( 57 instead of 56)
+        and article_sales_summary.start_txn_date between DATE_SUB(base.ref_dt, INTERVAL 57 DAY) and DATE_SUB(base.ref_dt, INTERVAL 1 DAY)
         and lylty_card_detail.crn != '0'
         and article_sales_summary.division_nbr in (1005,1030)
         group by 1,2
@@ -55,8 +56,8 @@ spend_26wk as (
     where article_sales_summary.lylty_card_nbr != '0'
     and lylty_card_detail.crn != '0'
     and article_sales_summary.division_nbr in (1005,1030)
-    -- changed the time interval to exclude the start_dt, moved start of windows back one day ( 183 instead of 182)
-    and article_sales_summary.start_txn_date between DATE_SUB('{start_dt}', INTERVAL 183 DAY) and DATE_SUB('{start_dt}', INTERVAL 1 DAY)    group by 1,2
+    -- changed the time interval to exclude the ref_dt, moved start of windows back one day ( 183 instead of 182)
+    and article_sales_summary.start_txn_date between DATE_SUB(base.ref_dt, INTERVAL 183 DAY) and DATE_SUB(base.ref_dt, INTERVAL 1 DAY)    group by 1,2
 )
 select base.ref_dt,
        base.crn,
@@ -0,0 +1,68 @@
+-- Approximate nearest Control of every Target, matched inside BigQuery on the
+-- weighted percentile ranks of the match input (see prepare_match_sem.sql).
+-- Target and Control of the same segment are hashed into buckets by random
+-- projections of their features (see lsh_match_sql); the Controls sharing a
+-- bucket with a Target in any hash table are its candidates, and the nearest
+-- candidate is its match. Targets without candidates are hashed again into
+-- wider buckets, level by level, and written without a match after the last.
+-- The buckets are scaled by the Control of each segment, so they hold about the
+-- same number of Controls in small and large segments.
+with sized as (
+    select *
+         , {cell_size} as cell
+    from (
+        select match_input.*
+             , countif(flag = 0) over (partition by ref_dt{segment_partition}) as n_control
+        from `{dam-project}.{dam-dataset}.{match_input}` match_input
+    )
+)
+,
+hashed as (
+    select flag
+         , ref_dt
+         , crn{segment_columns}{carried_columns}
+         , {feature_columns}
+         , {hash_columns}
+    from sized
+)
+,
+target as (
+    select *
+    from hashed
+    where flag = 1
+)
+,
+control as (
+    select *
+    from hashed
+    where flag = 0
+)
+,
+{candidate_levels}
+,
+candidates as (
+    {candidates}
+)
+,
+ranked as (
+    select crn
+         , ref_dt
+         , crn_0
+         , dist
+         , row_number() over (partition by crn, ref_dt order by dist, crn_0) as rank_
+    -- A Control sharing buckets with a Target in several tables is one candidate.
+    from (
+        select distinct crn, ref_dt, crn_0, dist
+        from candidates
+    )
+)
+select cast(target.ref_dt as date) as ref_dt
+     , cast(target.crn as string) as crn
+     , cast(ranked.crn_0 as string) as crn_0
+     , ranked.dist / {dist_scale} as dist_0{output_columns}
+from target
+left join ranked
+on target.crn = ranked.crn
+and target.ref_dt = ranked.ref_dt
+and ranked.rank_ = 1
+;
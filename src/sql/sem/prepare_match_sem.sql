@@ -0,0 +1,65 @@
+-- Match-ready Target and Control in one table, flagged by 'flag' (1 for Target).
+-- Controls with a CVM the Target of the week does not have (INACTIVE, LAPSED) are
+-- dropped, the CVM value and share of wallet are looked up, and every numerical
+-- variable is replaced by its weighted percentile rank over Target and Control
+-- of the week (the rank_columns argument, see rank_feature_sql). The other columns
+-- of var_cat and out_vars are carried as they are (see carried_columns).
+with pooled as (
+    select 1 as flag, target.*
+    from `{dam-project}.{dam-dataset}.{target}` target
+
+    union all
+    select 0 as flag, control.*
+    from `{dam-project}.{dam-dataset}.{control}` control
+)
+,
+target_cvm as (
+    select ref_dt
+         , logical_or(cvm = 'INACTIVE') as has_inactive
+         , logical_or(cvm = 'LAPSED') as has_lapsed
+    from pooled
+    where flag = 1
+    group by 1
+)
+,
+cvm_lookup as (
+    -- according to the Quantium CVM model, as in cvm_encoding
+    select *
+    from unnest([
+        struct('HVHIGH' as cvm, 4.0 as cvm_value, 4.0 as cvm_sow),
+        ('HVMED', 4.0, 2.5),
+        ('MVHIGH', 3.0, 4.0),
+        ('MVMEDA', 3.0, 3.0),
+        ('MVMEDB', 3.0, 2.0),
+        ('LVHFA', 2.0, 4.0),
+        ('LVHFB', 2.0, 2.5),
+        ('LVLF', 1.0, 4.0),
+        ('LVLFB', 1.0, 2.5),
+        ('LOW', 2.5, 1.0),
+        ('LAPSED', 0.0, 2.5),
+        ('INACTIVE', 0.0, 1.0)
+    ])
+)
+,
+filtered as (
+    select pooled.*
+         , cvm_lookup.cvm_value as CVM_value
+         , cvm_lookup.cvm_sow as CVM_SOW
+    from pooled
+    inner join target_cvm
+    on pooled.ref_dt = target_cvm.ref_dt
+    left join cvm_lookup
+    on pooled.cvm = cvm_lookup.cvm
+    where pooled.flag = 1
+    or (
+        (target_cvm.has_inactive or coalesce(pooled.cvm, '') not in ('INACTIVE', 'NA'))
+        and (target_cvm.has_lapsed or coalesce(pooled.cvm, '') not in ('LAPSED', 'NA'))
+    )
+)
+select flag
+     , ref_dt
+     , crn
+     , cvm{carried_columns}
+     , {rank_columns}
+from filtered
+;
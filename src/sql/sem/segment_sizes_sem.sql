@@ -0,0 +1,16 @@
+-- Target and Control rows of every segment, the combinations of the categorical
+-- variables, for planning the match shards (see plan_shards). The segment values
+-- are cast to strings, as they are compared by segment_mask.
+select {segment_vars}
+     , countif(flag = 1) as n_target
+     , countif(flag = 0) as n_control
+from (
+    select 1 as flag, {segment_columns}
+    from `{dam-project}.{dam-dataset}.{target}`
+
+    union all
+    select 0 as flag, {segment_columns}
+    from `{dam-project}.{dam-dataset}.{control}`
+)
+group by {segment_vars}
+;